@@ -0,0 +1,109 @@
+import os
+import re
+from dataclasses import dataclass
+
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from agents.llm import get_chat_model
+from utils.custom_log import log
+
+# 参数提取模式: json 使用提示词让模型返回 json; structured 使用模型的结构化输出(函数调用)
+extract_mode = os.getenv("TOOL_EXTRACT_MODE", "json")
+
+
+@dataclass(frozen=True)
+class ParamField:
+    """ 工具参数字段 """
+    # 字段名称，和接口参数一致
+    name: str
+    # 字段说明，会写进提示词
+    description: str
+    # 是否必传，缺少必传字段时不会调用接口
+    required: bool = False
+
+
+class ParamExtractor:
+    """ 工具参数提取器，提示词和 chain 只构建一次，所有工具共享同一个模型客户端 """
+
+    def __init__(self, name: str, fields: list[ParamField], note: str = ""):
+        self.name = name
+        self.fields = fields
+        # 额外的提取规则
+        self.note = note
+        self._chain = None
+
+    @property
+    def required(self) -> list[str]:
+        """ 必传字段 """
+        return [field.name for field in self.fields if field.required]
+
+    def template(self) -> str:
+        """ 生成提取参数的提示词 """
+        lines = [
+            "你是一个参数查询助手，根据用户输入的内容，找出相关的参数信息，并按 json 格式返回。",
+            "json字段如下:",
+            *[f'- "{field.name}": "{field.description}"' for field in self.fields],
+        ]
+        if self.required:
+            lines.append("如果必传字段缺少，那就提示用户告诉你这些内容。")
+        if self.note:
+            lines.append(self.note)
+        lines.append("只返回 json 格式的数据。不要返回其他内容。")
+        lines.append("用户输入: {query}")
+        return "\n".join(lines)
+
+    def json_schema(self) -> dict:
+        """
+        生成结构化输出的 schema。
+        这里不声明 required，否则模型会编造必传字段，缺失的字段由 missing 校验。
+        """
+        return {
+            "title": self.name,
+            "description": "根据用户输入的内容，找出相关的参数信息，没有提到的字段不要返回。",
+            "type": "object",
+            "properties": {
+                field.name: {"type": "string", "description": field.description}
+                for field in self.fields
+            },
+        }
+
+    @property
+    def chain(self):
+        """ 提取参数的 chain，第一次使用时构建 """
+        if self._chain is None:
+            llm = get_chat_model(streaming=False)
+            if extract_mode == "structured":
+                prompt = ChatPromptTemplate.from_template("用户输入: {query}")
+                self._chain = prompt | llm.with_structured_output(self.json_schema())
+            else:
+                prompt = ChatPromptTemplate.from_template(template=self.template())
+                self._chain = prompt | llm | JsonOutputParser()
+        return self._chain
+
+    def missing(self, data: dict) -> list[str]:
+        """ 返回缺少的必传字段 """
+        return [name for name in self.required if data.get(name) in (None, "")]
+
+    def missing_message(self, missing: list[str]) -> str:
+        """ 缺少必传字段时返回给 agent 的提示 """
+        names = "、".join(
+            re.split(r"[,，\s]", field.description)[0] for field in self.fields if field.name in missing
+        )
+        return f"缺少必填信息: {names}，请先询问用户提供这些信息，再调用这个工具。"
+
+    def clean(self, data) -> dict:
+        """ 去掉空值 """
+        if not isinstance(data, dict):
+            data = {}
+        data = {key: value for key, value in data.items() if value not in (None, "")}
+        log.info("%s 提取参数: %s", self.name, data)
+        return data
+
+    def extract(self, query: str) -> dict:
+        """ 从用户输入中提取参数 """
+        return self.clean(self.chain.invoke({"query": query}))
+
+    async def aextract(self, query: str) -> dict:
+        """ 异步从用户输入中提取参数 """
+        return self.clean(await self.chain.ainvoke({"query": query}))
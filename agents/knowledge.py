@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import re
+import unicodedata
+from contextvars import ContextVar
+from functools import lru_cache
+
+import numpy as np
+from langchain.retrievers.multi_query import DEFAULT_QUERY_PROMPT, LineListOutputParser
+from langchain_core.documents import Document
+
+from agents.llm import get_chat_model
+from utils.custom_log import log
+from utils.db import redis_client
+from utils import lexical
+from utils.embeddings import get_embeddings
+from utils.mmr import mmr_select
+from utils.stats import incr_stat
+from utils.vector_store import Hit, get_generation, lexical_namespace, search_vectors
+
+# 检索结果缓存时间，单位秒。知识库有写入时版本号变化，旧的缓存自然失效
+kb_cache_ttl = int(os.getenv("KB_CACHE_TTL", str(60 * 60 * 24)))
+# 问题扩展的缓存时间，扩展结果和知识库内容无关，可以缓存更久
+kb_expand_cache_ttl = int(os.getenv("KB_EXPAND_CACHE_TTL", str(60 * 60 * 24 * 7)))
+# 默认是否使用 llm 对问题进行多角度扩展
+kb_query_expansion = os.getenv("KB_QUERY_EXPANSION", "true").lower() in ("1", "true", "yes")
+
+# 检索模式: hybrid 向量和关键词检索融合; vector 只用向量检索; lexical 只用关键词检索，不需要向量化，延迟最低
+search_modes = ("hybrid", "vector", "lexical")
+kb_search_mode = os.getenv("KB_SEARCH_MODE", "hybrid")
+# 每次检索返回的文本块数量
+kb_top_k = int(os.getenv("KB_TOP_K", "4"))
+# 向量检索时每个问题取出的候选数量，MMR 从候选中挑选
+kb_fetch_k = int(os.getenv("KB_FETCH_K", "20"))
+# MMR 的相关度权重，1 只看相关度，0 只看多样性
+kb_mmr_lambda = float(os.getenv("KB_MMR_LAMBDA", "0.5"))
+# 融合后最多返回的文本块数量
+kb_result_limit = int(os.getenv("KB_RESULT_LIMIT", "8"))
+# RRF 融合的平滑参数
+rrf_k = int(os.getenv("KB_RRF_K", "60"))
+
+# 当前请求是否扩展问题，None 表示使用默认配置，对延迟敏感的请求可以关闭
+query_expansion: ContextVar[bool | None] = ContextVar("query_expansion", default=None)
+# 当前请求的检索模式，None 表示使用默认配置
+search_mode: ContextVar[str | None] = ContextVar("search_mode", default=None)
+
+# 问题末尾的标点，不影响检索结果
+_trailing_punctuation = re.compile(r"[\s。！？；，、.!?;,~～]+$")
+
+
+def normalize_query(query: str) -> str:
+    """ 规范化问题，全角转半角，统一小写，合并空白，去掉末尾的标点 """
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = " ".join(query.split())
+    return _trailing_punctuation.sub("", query)
+
+
+def query_hash(query: str) -> str:
+    """ 规范化后的问题哈希 """
+    return hashlib.sha1(normalize_query(query).encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_expand_chain():
+    """ 把问题交给 llm, 进行多角度扩展 """
+    return DEFAULT_QUERY_PROMPT | get_chat_model(streaming=False) | LineListOutputParser()
+
+
+def expand_query(query: str) -> list[str]:
+    """ 生成多个角度的问题，结果按规范化后的问题缓存 """
+    key = f"kb:expand:{query_hash(query)}"
+    cached = redis_client.get(key)
+    if cached is not None:
+        incr_stat("kb", "expand:hit")
+        return json.loads(cached)
+    incr_stat("kb", "expand:miss")
+
+    queries = [line.strip() for line in get_expand_chain().invoke({"question": query}) if line.strip()]
+    log.info("问题扩展结果: %s", queries)
+    redis_client.set(key, json.dumps(queries, ensure_ascii=False), ex=kb_expand_cache_ttl)
+    return queries
+
+
+def _document_key(doc: Document) -> str:
+    """ 文档的唯一标识，同样的内容来自向量检索和关键词检索时是同一个文档 """
+    return doc.metadata.get("content_hash") or doc.page_content
+
+
+def reciprocal_rank_fusion(rankings: list[list[Document]], limit: int = kb_result_limit,
+                           weights: list[float] | None = None) -> list[Document]:
+    """ RRF 融合多个排序结果，每个文档的得分是它在各个排序中 weight / (k + 名次) 的和，weights 默认都是 1 """
+    weights = weights or [1.0] * len(rankings)
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc in enumerate(ranking):
+            key = _document_key(doc)
+            scores[key] = scores.get(key, 0) + weight / (rrf_k + rank + 1)
+            documents.setdefault(key, doc)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)[:limit]]
+
+
+def vector_search(queries: list[str], k: int, fetch_k: int, lambda_mult: float) -> list[Document]:
+    """
+    向量检索: 所有问题一次向量化、一次批量检索候选和向量，按 id 合并后一次完成 MMR 和去重。
+    """
+    query_vectors = get_embeddings().embed_documents(queries)
+    # 多个问题的候选按 id 合并
+    candidates: dict[str, Hit] = {}
+    for hits in search_vectors(query_vectors, fetch_k):
+        for hit in hits:
+            candidates.setdefault(hit.id, hit)
+    if not candidates:
+        return []
+
+    hits = list(candidates.values())
+    selected = mmr_select(
+        np.asarray(query_vectors, dtype=np.float32),
+        np.asarray([hit.vector for hit in hits], dtype=np.float32),
+        k,
+        lambda_mult,
+    )
+    documents = []
+    for index in selected:
+        hit = hits[index]
+        metadata = {**hit.document.metadata, "_id": hit.id}
+        documents.append(Document(page_content=hit.document.page_content, metadata=metadata))
+    return documents
+
+
+def dump_documents(documents: list[Document]) -> str:
+    """ 序列化文档列表 """
+    return json.dumps(
+        [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+        ensure_ascii=False,
+        default=str,
+    )
+
+
+def load_documents(data: bytes | str) -> list[Document]:
+    """ 反序列化文档列表 """
+    return [Document(**item) for item in json.loads(data)]
+
+
+def search_documents(query: str, expand: bool | None = None, mode: str | None = None, k: int = kb_top_k,
+                     fetch_k: int = kb_fetch_k, lambda_mult: float = kb_mmr_lambda) -> list[Document]:
+    """
+    检索本地知识库。
+    expand 和 mode 为 None 时先看当前请求的设置，再看默认配置，lexical 模式默认不扩展问题。
+    k 是每个问题返回的文本块数量，fetch_k 是每个问题的向量候选数量，lambda_mult 是 MMR 的相关度权重。
+    融合后最多返回 max(k, KB_RESULT_LIMIT) 个文本块。
+    结果按知识库版本、检索参数和规范化后的问题缓存。
+    """
+    mode = mode or search_mode.get() or kb_search_mode
+    if mode not in search_modes:
+        mode = "hybrid"
+    if expand is None:
+        expand = query_expansion.get()
+    if expand is None:
+        expand = kb_query_expansion and mode != "lexical"
+
+    generation = get_generation()
+    key = f"kb:{generation}:docs:{mode}:{int(expand)}:{k}:{fetch_k}:{lambda_mult}:{query_hash(query)}"
+    cached = redis_client.get(key)
+    if cached is not None:
+        incr_stat("kb", "docs:hit")
+        log.info("知识库检索缓存命中: %s", key)
+        return load_documents(cached)
+    incr_stat("kb", "docs:miss")
+
+    # 多重查询，提高文档检索精确度，原始问题也参与检索
+    queries = [*expand_query(query), query] if expand else [query]
+
+    rankings, weights = [], []
+    if mode != "vector":
+        # 倒排索引在启动时和学习时建好，检索时不重建，还没建好时关键词检索返回空结果
+        namespace = lexical_namespace()
+        rankings += [lexical.search(namespace, item, k) for item in queries]
+        weights += [1.0] * len(queries)
+    if mode != "lexical":
+        # 所有问题的向量结果一次合并，数量和每个问题分别检索时一样；
+        # 合并后只有一个排序，权重按问题数量计算，和每个问题的关键词排序保持同样的比重
+        rankings.append(vector_search(queries, k * len(queries), max(fetch_k, k), lambda_mult))
+        weights.append(float(len(queries)))
+
+    documents = reciprocal_rank_fusion(rankings, max(k, kb_result_limit), weights)
+    log.info("知识库检索: 模式 %s, 问题 %s 个, 返回 %s 个文本块", mode, len(queries), len(documents))
+    redis_client.set(key, dump_documents(documents), ex=kb_cache_ttl)
+    return documents
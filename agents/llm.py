@@ -0,0 +1,17 @@
+import os
+from functools import lru_cache
+
+from langchain_openai import ChatOpenAI
+
+
+@lru_cache(maxsize=None)
+def get_chat_model(streaming: bool = True, tags: tuple[str, ...] = ()) -> ChatOpenAI:
+    """ 获取进程内共享的 chat model，避免每次对话都重新创建客户端, tags 用于在事件流中区分模型 """
+    return ChatOpenAI(
+        model=os.getenv('OPENAI_MODEL'),
+        api_key=os.getenv('OPENAI_API_KEY'),
+        base_url=os.getenv('OPENAI_API_BASE'),
+        streaming=streaming,
+        temperature=0,  # 不让模型生成随机性
+        tags=list(tags),
+    )
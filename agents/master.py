@@ -1,16 +1,19 @@
+import asyncio
 import os
+import threading
+from functools import lru_cache
 
-import requests
 from langchain.agents import AgentExecutor, create_tool_calling_agent
-from langchain.memory import ConversationTokenBufferMemory
-from langchain_community.chat_message_histories.redis import RedisChatMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import ChatOpenAI
 
+from agents.llm import get_chat_model
+from agents.memory import TokenWindowMemory, WindowedRedisChatMessageHistory
+from agents.qingxu import classify_qingxu
 from agents.templates import moods, sys_template
+from agents.voice import VoicePipeline, synthesize_cached
 from agents.tools import bazi_cesuan, jiemeng, local_db, search, shengxiao, yaogua, jiuxing, bazi_hehun, weilai, chenggu, zeshi, qiming
-from utils.oss import upload
+from utils.oss import copy, run_in_oss_executor
 
 from utils.custom_log import log
 
@@ -20,72 +23,143 @@ tools = [
 ]
 
 
+# 按情绪缓存的 agent 执行器，每种情绪在进程内只构建一次
+_agent_executors: dict[str, AgentExecutor] = {}
+_agent_lock = threading.Lock()
+
+# 内存 key
+memory_key = "chat_history"
+
+# 情绪判断模式: concurrent 和 agent 并发判断，只影响语音风格; serial 先判断再执行 agent; local 使用本地关键词判断
+qingxu_mode = os.getenv("QINGXU_MODE", "concurrent")
+
+# agent 模型的标签，用于在事件流中区分 agent 自身的输出
+agent_tag = "master_agent"
+
+
+# 情绪判断模板
+qingxu_template = """根据用户的输入，判断用户的情绪，回应规则如下:
+1. 如果用户输入的内容偏向于负面情绪，只返回"depresed"，不要有其他内容，否则将受到惩罚。
+2. 如果用户输入的内容偏向于正面情绪，只返回"friendly"，不要有其他内容，否则将受到惩罚。
+3. 如果用户输入的内容偏向于中性情绪，只返回"default"，不要有其他内容，否则将受到惩罚。
+4. 如果用户输入的内容中包含了辱骂等不礼貌语句，只返回"angry"，不要有其他内容，否则将受到惩罚。
+5. 如果用户输入的内容比较兴奋，只返回"upbeat"，不要有其他内容，否则将受到惩罚。
+6. 如果用户输入的内容比较悲伤，只返回"depressed"，不要有其他内容，否则将受到惩罚。
+7. 如果用户输入的内容比较开心，只返回"cheerful"，不要有其他内容，否则将受到惩罚。
+用户输入的内容是: {query}
+"""
+
+
+@lru_cache(maxsize=None)
+def get_qingxu_chain():
+    """ 获取情绪判断 chain，进程内只构建一次 """
+    prompt = ChatPromptTemplate.from_template(qingxu_template)
+    return prompt | get_chat_model() | StrOutputParser()
+
+
+def build_agent_executor(qingxu: str) -> AgentExecutor:
+    """ 构建指定情绪的 agent 执行器，系统提示词在这里就格式化好 """
+    log.info("构建 agent 执行器: %s", qingxu)
+
+    # 创建 prompt, 用于格式化输入输出
+    prompt = ChatPromptTemplate.from_messages([
+        (
+            "system",
+            sys_template.format(who_you_are=moods[qingxu]["roleSet"])
+        ),
+        # 内存占位符
+        MessagesPlaceholder(variable_name=memory_key),
+        (
+            "user",
+            "{input}"
+        ),
+        # 消息占位符，这里必须要有，用于格式化输出
+        MessagesPlaceholder(variable_name="agent_scratchpad")
+    ])
+
+    # 创建 agent, create_tool_calling_agent 对不同的大模型进行了封装，可以直接调用工具
+    agent = create_tool_calling_agent(
+        llm=get_chat_model(tags=(agent_tag,)),
+        prompt=prompt,
+        tools=tools
+    )
+
+    # 创建 agent 执行器, 不挂载内存，内存按请求单独传入
+    return AgentExecutor(
+        agent=agent,
+        tools=tools,
+        verbose=True,
+        # return_intermediate_steps=True, # 开启中间步骤返回，只有在需要调试的时候开启，或者需要返回中间步骤的时候开启
+    )
+
+
+def get_agent_executor(qingxu: str = "default") -> AgentExecutor:
+    """ 获取指定情绪的 agent 执行器，不存在的情绪使用默认情绪 """
+    if qingxu not in moods:
+        qingxu = "default"
+
+    executor = _agent_executors.get(qingxu)
+    if executor is None:
+        with _agent_lock:
+            executor = _agent_executors.get(qingxu)
+            if executor is None:
+                executor = build_agent_executor(qingxu)
+                _agent_executors[qingxu] = executor
+    return executor
+
+
 class Master:
     def __init__(self, user_id: str = "user_id"):
-        # 创建 chat model
-        self.chatModel = ChatOpenAI(
-            model=os.getenv('OPENAI_MODEL'),
-            api_key=os.getenv('OPENAI_API_KEY'),
-            base_url=os.getenv('OPENAI_API_BASE'),
-            streaming=True,
-            temperature=0,  # 不让模型生成随机性
-        )
+        # 使用进程内共享的 chat model
+        self.chatModel = get_chat_model()
         self.QingXu = "default"
+        # 并发模式下的情绪判断任务
+        self.qingxu_task: asyncio.Task | None = None
         # 创建内存 key
-        self.memory_key = "chat_history"
+        self.memory_key = memory_key
         # 创建内存
-        self.memory = self.get_memory(user_id)
-        memory = ConversationTokenBufferMemory(
-            llm=self.chatModel,  # 语言模型
-            human_prefix="用户",  # 人类的前缀
-            ai_prefix="周大师",  # AI 的前缀
+        self.chat_history = self.get_memory(user_id)
+        # 只有会话内存是按请求创建的
+        self.memory = TokenWindowMemory(
             memory_key=self.memory_key,  # 内存 key
             output_key="output",  # 输出 key
             max_token_limit=4000,  # 最大 token 限制，避免内存使用无限增长
-            return_messages=True,  # 返回消息
-            chat_memory=self.memory,  # 聊天内存
-        )
-
-        # 创建 prompt, 用于格式化输入输出
-        self.prompt = ChatPromptTemplate.from_messages([
-            (
-                "system",
-                sys_template.format(who_you_are=moods[self.QingXu]["roleSet"])
-            ),
-            # 内存占位符
-            MessagesPlaceholder(variable_name=self.memory_key),
-            (
-                "user",
-                "{input}"
-            ),
-            # 消息占位符，这里必须要有，用于格式化输出
-            MessagesPlaceholder(variable_name="agent_scratchpad")
-        ])
-
-        # 创建 agent, create_tool_calling_agent 对不同的大模型进行了封装，可以直接调用工具
-        agent = create_tool_calling_agent(
-            llm=self.chatModel,
-            prompt=self.prompt,
-            tools=tools
-        )
-
-        # 创建 agent 执行器
-        self.agent_executor = AgentExecutor(
-            agent=agent,
-            tools=tools,
-            memory=memory,
-            verbose=True,
-            # return_intermediate_steps=True, # 开启中间步骤返回，只有在需要调试的时候开启，或者需要返回中间步骤的时候开启
+            chat_memory=self.chat_history,  # 聊天内存
         )
 
-    def run(self, query):
+    async def astream(self, query: str):
+        """ 异步流式执行 agent，逐个返回回答的文本片段 """
         log.info("执行用户输入: %s", query)
 
         # 提取用户的情绪类型
-        self.qingxu_chain(query)
-
-        # 执行 agent
-        result = self.agent_executor.stream({"input": query})
+        if qingxu_mode == "local":
+            # 本地关键词判断，开销很小，可以直接用于选择 agent
+            self.QingXu = classify_qingxu(query)
+            log.info("本地情绪判断结果: %s", self.QingXu)
+        elif qingxu_mode == "serial":
+            # 先判断情绪再执行 agent，会多一次串行的大模型调用
+            await self.aqingxu_chain(query)
+        else:
+            # 情绪判断和 agent 并发执行，结果只用于语音风格
+            self.qingxu_task = asyncio.create_task(self.aqingxu_chain(query))
+
+        # 获取缓存的 agent 执行器
+        agent_executor = get_agent_executor(self.QingXu)
+
+        # 加载会话内存, redis 读取放到线程里执行，避免阻塞事件循环
+        memory_variables = await asyncio.to_thread(self.memory.load_memory_variables, {})
+        inputs = {"input": query, **memory_variables}
+
+        output = ""
+        # 执行 agent, 只关注 agent 自身模型的 token 流，工具内部的模型调用不会返回给用户
+        # 同步工具在异步执行器里会被放到线程池执行，不会阻塞事件循环
+        async for event in agent_executor.astream_events(inputs, version="v1", include_tags=[agent_tag]):
+            if event["event"] != "on_chat_model_stream":
+                continue
+            token = event["data"]["chunk"].content
+            if token:
+                output += token
+                yield token
 
         # data = result["intermediate_steps"][0]
         # action = data[0]
@@ -100,103 +174,58 @@ class Master:
         #     # 返回结果
         #     return doc.content
 
-        # 返回结果
-        return result
+        # 保存本轮对话到会话内存
+        await asyncio.to_thread(self.memory.save_context, {"input": query}, {"output": output})
 
     def get_memory(self, user_id: str):
-        """获取内存，基于 redis 实现"""
+        """获取内存，基于 redis 实现, 只读取摘要和最近的消息，摘要压缩在后台执行"""
         log.info('获取用户内存: %s', user_id)
 
-        chat_history = RedisChatMessageHistory(
+        return WindowedRedisChatMessageHistory(
             url=os.getenv("REDIS_URL"),
             session_id=user_id,  # 会话 id, 这里是模拟，实际需要传入登录用户的 ID
         )
-        store_messages = chat_history.messages
-        if len(store_messages) > 30:
-            try:
-                # 创建一个新的 prompt
-                prompt = ChatPromptTemplate.from_messages([
-                    (
-                        "system",
-                        sys_template+"\n这是一段你和用户的对话记忆，对其进行总结摘要，以便下次对话时使用。"
-                    ),
-                    ("user", "{input}"),
-                ])
-                # 创建一个新的 chain
-                chain = prompt | self.chatModel
-                # 对历史对话进行摘要
-                summary = chain.invoke(
-                    {"input": store_messages, "who_you_are": moods[self.QingXu]["roleSet"]})
-                # 清空历史记录
-                chat_history.clear()
-                # 添加摘要到历史记录
-                chat_history.add_message(summary)
-            except Exception as e:
-                log.error('摘要历史会话出错: %s', e)
-                # 清空异常的历史记录
-                chat_history.clear()
-                # 恢复历史记录
-                chat_history.add_messages(store_messages)
-        # 返回历史记录
-        return chat_history
-
-    def qingxu_chain(self, query: str):
-        log.info("情绪判断开始")
 
-        template = """根据用户的输入，判断用户的情绪，回应规则如下:
-        1. 如果用户输入的内容偏向于负面情绪，只返回"depresed"，不要有其他内容，否则将受到惩罚。
-        2. 如果用户输入的内容偏向于正面情绪，只返回"friendly"，不要有其他内容，否则将受到惩罚。
-        3. 如果用户输入的内容偏向于中性情绪，只返回"default"，不要有其他内容，否则将受到惩罚。
-        4. 如果用户输入的内容中包含了辱骂等不礼貌语句，只返回"angry"，不要有其他内容，否则将受到惩罚。
-        5. 如果用户输入的内容比较兴奋，只返回"upbeat"，不要有其他内容，否则将受到惩罚。
-        6. 如果用户输入的内容比较悲伤，只返回"depressed"，不要有其他内容，否则将受到惩罚。
-        7. 如果用户输入的内容比较开心，只返回"cheerful"，不要有其他内容，否则将受到惩罚。
-        用户输入的内容是: {query}
-        """
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | self.chatModel | StrOutputParser()
-        result = chain.invoke({"query": query})
+    async def aqingxu_chain(self, query: str):
+        log.info("情绪判断开始")
+        result = (await get_qingxu_chain().ainvoke({"query": query})).strip()
         self.QingXu = result
         log.info("情绪判断结果: %s", result)
         return result
 
+    async def wait_qingxu(self):
+        """ 等待并发的情绪判断完成，失败时使用默认情绪 """
+        if self.qingxu_task is None:
+            return
+        try:
+            await self.qingxu_task
+        except Exception as e:
+            log.error('情绪判断出错: %s', e)
+            self.QingXu = "default"
+        finally:
+            self.qingxu_task = None
+
+    async def get_voice_style(self) -> str:
+        """ 获取语音风格，依赖情绪判断结果 """
+        await self.wait_qingxu()
+        return moods.get(str(self.QingXu), {"voiceStyle": "default"})["voiceStyle"]
+
+    def voice_pipeline(self, uid: str, on_segment) -> VoicePipeline:
+        """ 创建句子级别的流式语音合成 """
+        return VoicePipeline(uid, self.get_voice_style, on_segment)
+
     async def get_voice(self, text: str, uid: str):
         """获取语音"""
         log.info('获取语音执行')
 
-        # 使用微软语音合成, 具体参数可以参考微软文档 https://learn.microsoft.com/en-us/azure/ai-services/speech-service/rest-text-to-speech?tabs=streaming
-
-        key = os.getenv("AZURE_SPEECH_KEY")
-        headers = {
-            'Ocp-Apim-Subscription-Key': key,  # 你的订阅密钥
-            'Content-Type': 'application/ssml+xml',  # 指定所提供文本的内容类型
-            'X-Microsoft-OutputFormat': 'audio-24khz-160kbitrate-mono-mp3',  # 指定音频输出格式。
-            'User-Agent': "william's bot"  # 应用程序名称
-        }
-
-        body = f"""<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts="https://www.w3.org/2001/mstts" xml:lang='zh-CN'>
-            <voice name='zh-CN-YunzeNeural'>
-                <mstts:express-as role='SeniorMale' style='{moods.get(str(self.QingXu), {"voiceStyle": "default"})["voiceStyle"]}'>
-                    {text}
-                </mstts:express-as>
-            </voice>
-        </speak>"""
-
-        # 发送请求
-        response = requests.post(
-            url='https://eastus.tts.speech.microsoft.com/cognitiveservices/v1',
-            headers=headers,
-            data=body.encode('utf-8'),
-            timeout=10
-        )
+        # 语音风格依赖情绪判断结果
+        voice_style = await self.get_voice_style()
 
-        if response.status_code == 200:
-            log.info('语音合成成功')
-            try:
-                # 上传到云端
-                upload(f'{uid}.mp3', response.content)
+        try:
+            # 相同的内容只合成上传一次，再复制成本次回答的文件
+            name = await synthesize_cached(text, voice_style)
+            if name is not None:
+                await run_in_oss_executor(copy, name, f'{uid}.mp3')
                 log.info('上传成功')
-            except Exception as e:
-                log.error('上传失败: %s', e)
-        else:
-            log.error('语音合成失败: %s', response)
+        except Exception as e:
+            log.error('上传失败: %s', e)
@@ -0,0 +1,211 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Sequence
+
+import redis
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_community.chat_message_histories.redis import RedisChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage, get_buffer_string, message_to_dict, messages_from_dict
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from agents.llm import get_chat_model
+from agents.templates import moods, sys_template
+from utils.custom_log import log
+from utils.tokens import count_message_tokens
+
+# 会话消息超过这个数量时，触发后台摘要压缩
+summary_threshold = int(os.getenv("MEMORY_SUMMARY_THRESHOLD", "30"))
+# 压缩后保留的最近消息数量，其余的消息合并到摘要里
+summary_keep = int(os.getenv("MEMORY_SUMMARY_KEEP", "10"))
+
+# 后台压缩线程池，压缩不占用请求路径
+_compact_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MEMORY_SUMMARY_WORKERS", "2")),
+    thread_name_prefix="memory-compact"
+)
+# 正在压缩的会话，避免同一个会话重复排队
+_compacting: set[str] = set()
+_compacting_lock = threading.Lock()
+
+
+class WindowedRedisChatMessageHistory(RedisChatMessageHistory):
+    """ 基于 redis 的会话历史，只读取摘要和最近窗口内的消息，超长时在后台压缩 """
+
+    def __init__(self, session_id: str, url: str, window: int = summary_threshold, **kwargs):
+        super().__init__(session_id=session_id, url=url, **kwargs)
+        # 每次最多读取的消息数量
+        self.window = window
+
+    @property
+    def summary_key(self) -> str:
+        """ 摘要的 key """
+        return f"message_summary:{self.session_id}"
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """ 读取摘要和最近的消息 """
+        return self.window_messages()
+
+    @messages.setter
+    def messages(self, messages: List[BaseMessage]) -> None:
+        raise NotImplementedError(
+            "Direct assignment to 'messages' is not allowed."
+            " Use the 'add_messages' instead."
+        )
+
+    def window_messages(self, max_token_limit: int | None = None) -> List[BaseMessage]:
+        """
+        按下标范围只读取最近的消息，消息是 lpush 写入的，最新的在最前面。
+        每条消息都存了写入时计算好的 token 数量，按 token 限制裁剪只需要做加法。
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(self.summary_key)
+        pipe.lrange(self.key, 0, self.window - 1)
+        summary, _items = pipe.execute()
+
+        summary_message = None
+        total = 0
+        if summary:
+            summary_message = SystemMessage(content=f"以下是之前对话的摘要: {summary.decode('utf-8')}")
+            if max_token_limit is not None:
+                total = count_message_tokens(summary_message)
+
+        items = []
+        for m in _items:
+            item = json.loads(m.decode("utf-8"))
+            if max_token_limit is not None:
+                # 兼容旧数据，没有存 token 数量的消息现场计算
+                tokens = item.get("tokens")
+                if tokens is None:
+                    tokens = count_message_tokens(messages_from_dict([item])[0])
+                if total + tokens > max_token_limit:
+                    break
+                total += tokens
+            items.append(item)
+
+        messages = messages_from_dict(items[::-1])
+        if summary_message is not None:
+            messages.insert(0, summary_message)
+        return messages
+
+    def add_message(self, message: BaseMessage) -> None:
+        """ 添加消息 """
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """ 批量添加消息，同时存储每条消息的 token 数量，超过阈值时提交后台压缩 """
+        items = [
+            json.dumps({**message_to_dict(message), "tokens": count_message_tokens(message)})
+            for message in messages
+        ]
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.lpush(self.key, *items)
+        if self.ttl:
+            pipe.expire(self.key, self.ttl)
+        length = pipe.execute()[0]
+        if length > summary_threshold:
+            schedule_compaction(self)
+
+    def clear(self) -> None:
+        """ 清空会话历史和摘要 """
+        self.redis_client.delete(self.key, self.summary_key)
+
+
+class TokenWindowMemory(BaseChatMemory):
+    """ 按 token 限制读取最近会话历史的内存，裁剪使用存储好的 token 数量 """
+
+    chat_memory: WindowedRedisChatMessageHistory
+    memory_key: str = "chat_history"
+    # 最大 token 限制，避免内存使用无限增长
+    max_token_limit: int = 4000
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def memory_variables(self) -> List[str]:
+        """ 内存变量 """
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """ 加载最近的会话历史 """
+        return {self.memory_key: self.chat_memory.window_messages(self.max_token_limit)}
+
+
+@lru_cache(maxsize=None)
+def get_summary_chain():
+    """ 获取增量摘要 chain，进程内只构建一次 """
+    prompt = ChatPromptTemplate.from_messages([
+        (
+            "system",
+            sys_template + "\n下面是你和用户之前对话的摘要，以及新增的对话记忆，把它们合并成一份新的摘要，以便下次对话时使用。"
+        ),
+        ("user", "之前的摘要:\n{summary}\n\n新增的对话:\n{input}"),
+    ])
+    return prompt | get_chat_model(streaming=False) | StrOutputParser()
+
+
+def schedule_compaction(history: WindowedRedisChatMessageHistory):
+    """ 提交后台压缩任务，同一个会话同时只会有一个任务 """
+    with _compacting_lock:
+        if history.session_id in _compacting:
+            return
+        _compacting.add(history.session_id)
+    _compact_executor.submit(_compact_worker, history)
+
+
+def _compact_worker(history: WindowedRedisChatMessageHistory):
+    """ 后台压缩任务入口 """
+    try:
+        compact_history(history)
+    except Exception as e:
+        log.error('摘要历史会话出错: %s', e)
+    finally:
+        with _compacting_lock:
+            _compacting.discard(history.session_id)
+
+
+def compact_history(history: WindowedRedisChatMessageHistory) -> bool:
+    """ 把最旧的消息和已有摘要合并成新摘要，使用 redis 事务原子替换 """
+    client = history.redis_client
+    length = client.llen(history.key)
+    if length <= summary_threshold:
+        return False
+
+    # 需要合并到摘要的最旧消息数量, 它们在列表的尾部
+    count = length - summary_keep
+    old_summary = client.get(history.summary_key)
+    _items = client.lrange(history.key, length - count, -1)
+    old_messages = messages_from_dict([json.loads(m.decode("utf-8")) for m in _items[::-1]])
+
+    log.info('开始压缩会话历史: %s, 合并 %s 条消息', history.session_id, count)
+    summary = get_summary_chain().invoke({
+        "summary": old_summary.decode("utf-8") if old_summary else "无",
+        "input": get_buffer_string(old_messages, human_prefix="用户", ai_prefix="周大师"),
+        "who_you_are": moods["default"]["roleSet"],
+    })
+
+    with client.pipeline(transaction=True) as pipe:
+        try:
+            # 其他进程已经更新了摘要，放弃本次结果
+            pipe.watch(history.summary_key)
+            if pipe.get(history.summary_key) != old_summary:
+                log.info('会话摘要已被更新，跳过: %s', history.session_id)
+                return False
+            pipe.multi()
+            pipe.set(history.summary_key, summary)
+            # 新消息都是从头部写入的，只裁掉尾部已经合并的消息
+            pipe.ltrim(history.key, 0, -(count + 1))
+            if history.ttl:
+                pipe.expire(history.summary_key, history.ttl)
+            pipe.execute()
+        except redis.WatchError:
+            log.info('会话摘要并发更新，跳过: %s', history.session_id)
+            return False
+
+    log.info('会话历史压缩完成: %s', history.session_id)
+    return True
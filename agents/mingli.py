@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+from utils.custom_log import log
+from utils.db import async_redis_client
+from utils.http import apost
+from utils.stats import aincr_stat
+
+# 命理接口结果的缓存时间，单位秒。相同的出生信息查询结果是确定的，可以用 MINGLI_CACHE_TTL_工具名 覆盖
+# yaogua 每次结果都是随机的，jiemeng、zeshi、qiming 不在缓存范围内
+mingli_cache_ttl = {
+    name: int(os.getenv(f"MINGLI_CACHE_TTL_{name.upper()}", ttl))
+    for name, ttl in {
+        "bazi_cesuan": 60 * 60 * 24 * 30,
+        "chenggu": 60 * 60 * 24 * 30,
+        "bazi_hehun": 60 * 60 * 24 * 30,
+        "shengxiao": 60 * 60 * 24 * 30,
+        "jiuxing": 60 * 60 * 24 * 7,
+        "weilai": 60 * 60 * 24 * 7,
+    }.items()
+}
+
+
+def normalize_params(data: dict) -> dict:
+    """ 规范化请求参数，去掉 api_key，去掉空白，数字统一格式 """
+    params = {}
+    for key, value in data.items():
+        if key == "api_key" or value in (None, ""):
+            continue
+        value = str(value).strip()
+        if value.isdigit():
+            value = str(int(value))
+        params[key] = value.lower()
+    return params
+
+
+def mingli_cache_key(name: str, data: dict) -> str:
+    """ 缓存 key，只和工具名称以及规范化后的参数有关 """
+    params = json.dumps(normalize_params(data), sort_keys=True, ensure_ascii=False)
+    return f"mingli:{name}:{hashlib.sha1(params.encode('utf-8')).hexdigest()}"
+
+
+async def call_mingli(name: str, url_env: str, data: dict) -> dict | None:
+    """
+    调用命理接口，url_env 是接口地址对应的环境变量，成功返回接口的 json 数据，失败返回 None。
+    确定性的接口结果会缓存到 redis 中。
+    """
+    ttl = mingli_cache_ttl.get(name)
+    key = mingli_cache_key(name, data) if ttl else None
+
+    if key:
+        # 缓存不可用时直接调用接口
+        try:
+            cached = await async_redis_client.get(key)
+            if cached is not None:
+                await aincr_stat("mingli", f"{name}:hit")
+                log.info("命理接口缓存命中: %s", key)
+                return json.loads(cached)
+            await aincr_stat("mingli", f"{name}:miss")
+        except Exception as e:
+            log.error("读取命理接口缓存出错: %s %s", key, e)
+
+    result = await apost(
+        os.getenv(url_env),
+        data={"api_key": os.getenv("TOOLS_MINGLI_KEY"), **data}
+    )
+
+    if result.status_code != 200:
+        log.error("返回数据异常: %s", result)
+        return None
+
+    res = result.json()
+    # 只缓存有数据的结果，参数错误之类的结果不缓存
+    if key and isinstance(res, dict) and res.get("data"):
+        try:
+            await async_redis_client.set(key, json.dumps(res, ensure_ascii=False), ex=ttl)
+        except Exception as e:
+            log.error("写入命理接口缓存出错: %s %s", key, e)
+    return res
@@ -0,0 +1,39 @@
+from functools import lru_cache
+
+from agents.templates import moods
+
+# 情绪关键词词典，key 必须是 moods 中定义的情绪
+qingxu_lexicon = {
+    "angry": [
+        "傻逼", "傻b", "sb", "滚", "妈的", "他妈", "去死", "垃圾", "废物", "骗子", "混蛋", "王八蛋", "闭嘴", "蠢", "白痴",
+        "气死", "生气", "愤怒", "可恶",
+    ],
+    "depressed": [
+        "难过", "伤心", "痛苦", "失落", "绝望", "想哭", "哭了", "郁闷", "倒霉", "失恋", "分手", "离婚", "失业", "不顺",
+        "焦虑", "担心", "害怕", "烦", "累了", "没希望", "唉", "悲伤",
+    ],
+    "upbeat": [
+        "太棒", "激动", "兴奋", "终于", "成功了", "中奖", "升职", "加薪", "考上", "冲", "!!", "！！",
+    ],
+    "cheerful": [
+        "开心", "高兴", "哈哈", "快乐", "嘻嘻", "呵呵", "幸福", "美滋滋", "好玩", "有趣",
+    ],
+    "friendly": [
+        "谢谢", "感谢", "多谢", "您好", "你好", "请问", "麻烦", "辛苦", "大师", "拜托",
+    ],
+}
+
+
+@lru_cache(maxsize=4096)
+def classify_qingxu(query: str) -> str:
+    """ 本地关键词打分判断用户情绪，不调用大模型，命中最多的情绪胜出，没有命中返回 default """
+    text = query.lower()
+
+    best, best_score = "default", 0
+    for qingxu, keywords in qingxu_lexicon.items():
+        if qingxu not in moods:
+            continue
+        score = sum(text.count(keyword) for keyword in keywords)
+        if score > best_score:
+            best, best_score = qingxu, score
+    return best
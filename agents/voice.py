@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import os
+import re
+from typing import Awaitable, Callable, Coroutine
+from xml.sax.saxutils import escape
+
+from utils.custom_log import log
+from utils.db import redis_client
+from utils.http import apost
+from utils.oss import audio_exists, run_in_oss_executor, upload
+from utils.stats import incr_stat
+
+# 使用微软语音合成, 具体参数可以参考微软文档 https://learn.microsoft.com/en-us/azure/ai-services/speech-service/rest-text-to-speech?tabs=streaming
+tts_url = 'https://eastus.tts.speech.microsoft.com/cognitiveservices/v1'
+# 发音人
+voice_name = 'zh-CN-YunzeNeural'
+# 音频输出格式
+output_format = 'audio-24khz-160kbitrate-mono-mp3'
+
+# 语音缓存在 redis 中的索引过期时间，过期后会回源检查云端文件
+tts_cache_ttl = int(os.getenv("TTS_CACHE_TTL", str(60 * 60 * 24 * 30)))
+
+# 句子结束的标点，遇到这些标点就切出一句
+sentence_end = re.compile(r'[。！？；!?;\n]+')
+# 太短的句子和下一句合并，避免请求过碎
+min_sentence_length = int(os.getenv("TTS_MIN_SENTENCE_LENGTH", "8"))
+# 单个回答同时合成的句子数量
+tts_concurrency = int(os.getenv("TTS_CONCURRENCY", "3"))
+# 整个进程同时进行的语音合成请求数量
+tts_max_inflight = int(os.getenv("TTS_MAX_INFLIGHT", "16"))
+tts_semaphore = asyncio.Semaphore(tts_max_inflight)
+
+# 正在执行的后台语音任务，关闭服务时等待它们完成
+voice_jobs: set[asyncio.Task] = set()
+
+
+def clean_text(text: str) -> str:
+    """ 去掉星号和井号，避免语音读出来 """
+    return text.replace("*", "").replace("#", "")
+
+
+async def synthesize(text: str, voice_style: str) -> bytes | None:
+    """ 合成语音，成功返回 mp3 数据 """
+    headers = {
+        'Ocp-Apim-Subscription-Key': os.getenv("AZURE_SPEECH_KEY"),  # 你的订阅密钥
+        'Content-Type': 'application/ssml+xml',  # 指定所提供文本的内容类型
+        'X-Microsoft-OutputFormat': output_format,  # 指定音频输出格式。
+        'User-Agent': "william's bot"  # 应用程序名称
+    }
+
+    body = f"""<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts="https://www.w3.org/2001/mstts" xml:lang='zh-CN'>
+            <voice name='{voice_name}'>
+                <mstts:express-as role='SeniorMale' style='{voice_style}'>
+                    {escape(text)}
+                </mstts:express-as>
+            </voice>
+        </speak>"""
+
+    # 发送请求, 使用共享的连接池，进程内同时合成的数量有上限
+    async with tts_semaphore:
+        response = await apost(
+            tts_url,
+            headers=headers,
+            content=body.encode('utf-8'),
+        )
+
+    if response.status_code == 200:
+        log.info('语音合成成功')
+        return response.content
+
+    log.error('语音合成失败: %s', response)
+    return None
+
+
+def voice_cache_key(text: str, voice_style: str) -> str:
+    """ 语音内容的哈希，相同文本、发音人、风格和格式的语音是同一个文件 """
+    content = "\0".join([text, voice_name, voice_style, output_format])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_cached_voice(text: str, voice_style: str) -> str | None:
+    """ 查找已经合成过的语音，命中返回云端的文件名称 """
+    key = voice_cache_key(text, voice_style)
+    name = f'tts/{key}.mp3'
+    if redis_client.exists(f"tts:{key}") or audio_exists('audio', name):
+        redis_client.set(f"tts:{key}", name, ex=tts_cache_ttl)
+        incr_stat("tts", "hit")
+        return name
+    incr_stat("tts", "miss")
+    return None
+
+
+def save_voice(text: str, voice_style: str, audio: bytes) -> str:
+    """ 按内容寻址上传语音，返回文件名称 """
+    key = voice_cache_key(text, voice_style)
+    name = f'tts/{key}.mp3'
+    upload(name, audio)
+    redis_client.set(f"tts:{key}", name, ex=tts_cache_ttl)
+    return name
+
+
+async def synthesize_cached(text: str, voice_style: str) -> str | None:
+    """ 合成语音并按内容寻址上传，相同的内容直接复用云端文件，返回文件名称 """
+    name = await run_in_oss_executor(get_cached_voice, text, voice_style)
+    if name is not None:
+        log.info('语音缓存命中: %s', name)
+        return name
+
+    audio = await synthesize(text, voice_style)
+    if audio is None:
+        return None
+
+    return await run_in_oss_executor(save_voice, text, voice_style, audio)
+
+
+def track_voice_task(coro: Coroutine) -> asyncio.Task:
+    """ 创建语音任务并记录下来，关闭服务时等待它们完成 """
+    task = asyncio.create_task(coro)
+    voice_jobs.add(task)
+    task.add_done_callback(voice_jobs.discard)
+    return task
+
+
+def submit_voice_job(coro: Coroutine) -> asyncio.Task:
+    """ 提交后台语音任务，任务会被记录下来，异常会被记录到日志 """
+    task = track_voice_task(coro)
+
+    def done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error('后台语音任务出错: %s', task.exception())
+
+    task.add_done_callback(done)
+    return task
+
+
+async def drain_voice_jobs(timeout: float = 30):
+    """ 等待所有后台语音任务完成，超时的任务会被取消 """
+    if not voice_jobs:
+        return
+    log.info('等待后台语音任务完成: %s', len(voice_jobs))
+    done, pending = await asyncio.wait(set(voice_jobs), timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+
+class SentenceSplitter:
+    """ 把流式输出的 token 切成句子 """
+
+    def __init__(self, min_length: int = min_sentence_length):
+        self.min_length = min_length
+        self.buffer = ""
+
+    def feed(self, token: str) -> list[str]:
+        """ 输入 token，返回已经完整的句子 """
+        self.buffer += token
+        sentences = []
+        start = 0
+        for match in sentence_end.finditer(self.buffer):
+            end = match.end()
+            if len(self.buffer[start:end].strip()) < self.min_length:
+                continue
+            sentences.append(self.buffer[start:end].strip())
+            start = end
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> str:
+        """ 返回剩余未结束的文本 """
+        rest, self.buffer = self.buffer.strip(), ""
+        return rest
+
+
+class VoicePipeline:
+    """
+    句子级别的流式语音合成。
+    回答还在生成的时候，就按句子并发合成语音，按句子顺序上传并通知，第一句可以先播放。
+    回答正常结束时调用 close 等待剩余的句子，出错或者连接断开时调用 cancel 取消所有任务。
+    """
+
+    def __init__(
+        self,
+        uid: str,
+        get_voice_style: Callable[[], Awaitable[str]],
+        on_segment: Callable[[str, int, str], Awaitable[None]],
+        concurrency: int = tts_concurrency,
+    ):
+        self.uid = uid
+        self.get_voice_style = get_voice_style
+        self.on_segment = on_segment
+        self.splitter = SentenceSplitter()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue: asyncio.Queue[asyncio.Task | None] = asyncio.Queue()
+        self.count = 0
+        # 本次回答还没有完成的句子合成任务
+        self.tasks: set[asyncio.Task] = set()
+        self.emitter = track_voice_task(self._emit())
+
+    def feed(self, token: str):
+        """ 输入回答的 token """
+        for sentence in self.splitter.feed(token):
+            self._submit(sentence)
+
+    async def close(self) -> int:
+        """ 合成剩余文本，等待所有句子通知完成，返回成功的片段数量 """
+        rest = self.splitter.flush()
+        if rest:
+            self._submit(rest)
+        await self.queue.put(None)
+        await self.emitter
+        return self.count
+
+    async def cancel(self):
+        """ 取消还没有完成的合成和通知，不再向客户端发送片段 """
+        tasks = [self.emitter, *self.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _submit(self, sentence: str):
+        """ 提交一句话的合成任务 """
+        text = clean_text(sentence).strip()
+        if not text:
+            return
+        task = track_voice_task(self._synthesize(text))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.queue.put_nowait(task)
+
+    async def _synthesize(self, text: str) -> str | None:
+        """ 合成并上传一句话，返回对象名称 """
+        async with self.semaphore:
+            voice_style = await self.get_voice_style()
+            return await synthesize_cached(text, voice_style)
+
+    async def _emit(self):
+        """ 按句子顺序通知已经合成好的片段 """
+        while True:
+            task = await self.queue.get()
+            if task is None:
+                break
+            try:
+                name = await task
+            except Exception as e:
+                log.error('片段语音合成出错: %s', e)
+                continue
+            if name is None:
+                continue
+            try:
+                await self.on_segment(self.uid, self.count, name)
+                self.count += 1
+            except Exception as e:
+                log.error('片段语音通知出错: %s', e)
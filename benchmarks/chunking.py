@@ -0,0 +1,78 @@
+"""
+文本切割的性能和 token 分布对比，在项目根目录执行:
+
+    python -m benchmarks.chunking [文本文件 ...]
+
+不传文件时使用内置的中文样例语料。
+before: CharacterTextSplitter(chunk_size=4000, length_function=len)，按字符数量切割，只在空行处切开。
+after: TokenTextSplitter，按模型 token 数量切割，优先在中文句子边界切开，每种来源的参数见 chunk_profiles。
+"""
+import statistics
+import sys
+import time
+
+from langchain_text_splitters import CharacterTextSplitter
+
+from utils.parse import get_text_splitter
+from utils.tokens import count_tokens
+
+# 每个切割器重复执行的轮数
+rounds = 5
+
+paragraphs = [
+    "八字又称四柱，是用天干地支表示一个人出生的年、月、日、时。古人认为，八字中五行的生克关系可以反映一个人的性格和运势。",
+    "生肖配对主要看两个人的属相是否相合，常见的说法有三合、六合、相冲、相害。相合的属相被认为相处融洽，相冲的属相则容易产生矛盾！",
+    "解梦是根据梦境的内容推测吉凶，比如梦见水通常代表财运，梦见蛇可能预示有贵人相助；不同的流派解释也不尽相同。",
+    "择日是根据黄历挑选适合做某件事情的日子，比如结婚、搬家、开业，需要避开和当事人生肖相冲的日子？",
+    "Feng shui is a traditional practice that arranges spaces to achieve harmony with the environment, and it is often combined with the bazi analysis.",
+]
+
+
+def build_corpus(repeat: int = 200) -> list[str]:
+    """ 构造测试用的语料，每篇文章由若干段落组成，段落之间有时用空行，有时直接换行 """
+    docs = []
+    for i in range(repeat):
+        lines = [paragraphs[(i + j) % len(paragraphs)] for j in range(i % 7 + 3)]
+        docs.append(("\n\n" if i % 2 else "\n").join(lines) * (i % 5 + 1))
+    return docs
+
+
+def load_corpus(paths: list[str]) -> list[str]:
+    """ 读取文本文件作为语料 """
+    docs = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            docs.append(f.read())
+    return docs
+
+
+def bench(name: str, split, corpus: list[str]):
+    """ 打印每秒切出的文本块数量和文本块的 token 分布 """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        chunks = [chunk for doc in corpus for chunk in split(doc)]
+    elapsed = (time.perf_counter() - start) / rounds
+
+    tokens = sorted(count_tokens(chunk) for chunk in chunks)
+    p50 = tokens[len(tokens) // 2]
+    p90 = tokens[int(len(tokens) * 0.9)]
+    print(
+        f"{name:>16} {len(chunks):>8} {len(chunks) / elapsed:>12.1f} {tokens[0]:>6} {p50:>6} {p90:>6} "
+        f"{tokens[-1]:>6} {statistics.mean(tokens):>8.1f} {statistics.pstdev(tokens):>8.1f}"
+    )
+
+
+def main():
+    corpus = load_corpus(sys.argv[1:]) if len(sys.argv) > 1 else build_corpus()
+    print(f"documents: {len(corpus)}, tokens: {sum(count_tokens(doc) for doc in corpus)}")
+    print(f"{'splitter':>16} {'chunks':>8} {'chunks/s':>12} {'min':>6} {'p50':>6} {'p90':>6} {'max':>6} {'mean':>8} {'stdev':>8}")
+
+    before = CharacterTextSplitter(chunk_size=4000, chunk_overlap=100, length_function=len)
+    bench("before", before.split_text, corpus)
+
+    for profile in ("default", "url", "xlsx", "map"):
+        bench(f"after:{profile}", get_text_splitter(profile).split_text, corpus)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+会话内存裁剪的性能对比，在项目根目录执行:
+
+    python -m benchmarks.memory_trim
+
+before: ConversationTokenBufferMemory 的做法，每轮通过 llm 对整段历史重新计算 token，超限时弹出最旧的消息再重新计算。
+after: 写入时计算好每条消息的 token 数量（本地分词器 + 哈希缓存），读取时从最新的消息开始累加。
+"""
+import os
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_openai import ChatOpenAI
+
+from utils.tokens import count_message_tokens
+
+# 最大 token 限制，和 Master 中的一致
+max_token_limit = 4000
+# 每种历史长度重复执行的轮数
+rounds = 20
+
+
+def build_history(turns: int):
+    """ 构造测试用的会话历史 """
+    messages = []
+    for i in range(turns):
+        messages.append(HumanMessage(content=f"周大师你好，我是第{i}次提问，我想算一下我的八字，我出生于1990年{i % 12 + 1}月{i % 28 + 1}日。"))
+        messages.append(AIMessage(content=f"小友你好，老夫已经为你测算完毕。你的八字五行偏旺，第{i}次测算结果显示今年运势平稳，事业有贵人相助。" * 3))
+    return messages
+
+
+def trim_before(llm: ChatOpenAI, messages: list):
+    """ 旧的裁剪方式 """
+    buffer = list(messages)
+    curr = llm.get_num_tokens_from_messages(buffer)
+    while curr > max_token_limit:
+        buffer.pop(0)
+        curr = llm.get_num_tokens_from_messages(buffer)
+    return buffer
+
+
+def trim_after(counted: list):
+    """ 新的裁剪方式，counted 是 (消息, token 数量) 列表 """
+    total = 0
+    kept = []
+    for message, tokens in reversed(counted):
+        if total + tokens > max_token_limit:
+            break
+        total += tokens
+        kept.append(message)
+    return kept[::-1]
+
+
+def bench(func, *args):
+    """ 返回每轮的平均耗时，单位毫秒 """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(*args)
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    llm = ChatOpenAI(model=os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo'), api_key="benchmark")
+
+    print(f"{'messages':>10} {'before(ms)':>12} {'after cold(ms)':>16} {'after warm(ms)':>16}")
+    for turns in (10, 50, 200, 1000):
+        messages = build_history(turns)
+
+        before = bench(trim_before, llm, messages)
+
+        # 冷缓存: 包含写入时计算 token 的开销，每条消息只会计算一次
+        start = time.perf_counter()
+        counted = [(message, count_message_tokens(message)) for message in messages]
+        cold = (time.perf_counter() - start) * 1000 + bench(trim_after, counted)
+
+        warm = bench(trim_after, counted)
+
+        print(f"{len(messages):>10} {before:>12.3f} {cold:>16.3f} {warm:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
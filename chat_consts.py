@@ -1,9 +1,11 @@
 import os
+from functools import lru_cache
 from utils.custom_log import log
 
 
+@lru_cache(maxsize=None)
 def qdrant_path(path: str = "local_qdrant") -> str:
-    """获取 qdrant向量数据库的绝对路径 """
+    """获取 qdrant向量数据库的绝对路径, 结果会被缓存 """
 
     # 获取当前工作目录的绝对路径
     current_dir = os.getcwd()
@@ -1,7 +1,23 @@
-from pydantic import BaseModel
+from typing import Literal
+
+from pydantic import BaseModel, Field
 
 
 class ChatBody(BaseModel):
     """ 对话请求体 """
     # 对话内容
     query: str
+    # 是否对知识库问题进行多角度扩展，不传使用默认配置，对延迟敏感时可以关闭
+    expand_query: bool | None = None
+    # 知识库检索模式: hybrid、vector、lexical，不传使用默认配置，lexical 不需要向量化，延迟最低
+    search_mode: Literal["hybrid", "vector", "lexical"] | None = None
+
+
+class AddUrlBody(BaseModel):
+    """ 网页学习请求体 """
+    # 网页链接列表
+    urls: list[str] = Field(default_factory=list)
+    # sitemap 地址，会学习 sitemap 中的所有网页
+    sitemap: str | None = None
+    # 沿着同一个域名的链接继续抓取的层数，0 表示只抓取给出的网页
+    depth: int = Field(default=0, ge=0, le=3)
@@ -2,6 +2,12 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from utils.custom_log import log
+from utils.http import close_async_client
+from agents.voice import drain_voice_jobs
+from services.ingest import shutdown_ingest, submit_task
+from utils.parse import shutdown_parse_executor
+from utils.vector_store import close_backends, ensure_lexical_index
+from utils.db import init_db
 from routers.base import router as base_router
 from routers.user import router as user_router
 from routers.tag import router as tag_router
@@ -12,7 +18,18 @@ from routers.message import router as message_router
 async def lifespan(app: FastAPI):
     """ server 生命周期 """
     log.info("ai服务启动")
+    # 创建数据库表, 如果表不存在的话，每个 worker 启动时执行一次
+    init_db()
+    # 还没有倒排索引时在学习线程池里重建，不占用检索请求
+    submit_task("重建倒排索引", ensure_lexical_index)
     yield
+    # 等待还没完成的语音任务
+    await drain_voice_jobs()
+    # 取消排队中的学习任务
+    shutdown_ingest()
+    shutdown_parse_executor()
+    close_backends()
+    await close_async_client()
     log.info("ai服务关闭")
 
 # 创建 FastAPI 实例
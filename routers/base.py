@@ -1,11 +1,13 @@
 from typing import Optional
-from fastapi import UploadFile, WebSocket, Depends, APIRouter
+from fastapi import UploadFile, WebSocket, Depends, APIRouter, HTTPException, status
 from fastapi.responses import StreamingResponse
 from utils.custom_log import log
-from models.chat import ChatBody
+from models.chat import AddUrlBody, ChatBody
 from services.guard import check_token
 from services.rag import save_file, add_url
+from services.ingest import get_job
 from services.chat import connect_ai, connect_ws
+from utils.stats import get_stats, hit_ratio
 import json
 
 
@@ -21,23 +23,69 @@ def read_root():
 @router.post("/chat")
 async def chat(body: ChatBody, user_id: int = Depends(check_token), ):
     """ 对话接口 """
-    result = connect_ai(body.query, user_id)
+    result = connect_ai(body.query, user_id, expand_query=body.expand_query, search_mode=body.search_mode)
     return StreamingResponse(result["generate"], media_type="text/event-stream", headers={"id": result["id"]})
 
 
 @router.post("/add_url", dependencies=[Depends(check_token)])
-def rag_url(url: str):
-    """ 添加网页链接，直接学习网页上的数据 """
-    return add_url(url)
+def rag_url(url: Optional[str] = None, body: Optional[AddUrlBody] = None):
+    """ 添加网页链接，后台学习网页上的数据，返回任务 id。可以传单个 url 参数，也可以传网页列表或者 sitemap """
+    body = body or AddUrlBody()
+    urls = [url, *body.urls] if url else body.urls
+    return add_url(urls, body.sitemap, body.depth)
 
 
 @router.post("/add_file", dependencies=[Depends(check_token)])
 async def rag_file(pdf_file: UploadFile):
-    """ 添加本地文件，直接学习本地文件中的数据 """
+    """ 添加本地文件，后台学习本地文件中的数据，返回任务 id """
     log.info("开始保存文件: %s", pdf_file.filename)
     return await save_file(pdf_file)
 
 
+@router.get("/ingest/{job_id}", dependencies=[Depends(check_token)])
+def ingest_status(job_id: str):
+    """ 查询学习任务的状态和每个阶段的进度 """
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="学习任务不存在"
+        )
+    return job
+
+
+@router.get("/stats", dependencies=[Depends(check_token)])
+def stats():
+    """ 缓存命中统计 """
+    tts = get_stats("tts")
+    embedding = get_stats("embedding")
+    # 命理接口的缓存按工具统计
+    mingli = get_stats("mingli")
+    tools = {name.split(":")[0] for name in mingli}
+    # 知识库的问题扩展和检索结果缓存
+    kb = get_stats("kb")
+    return {
+        "tts": {**tts, "hit_ratio": hit_ratio(tts)},
+        "embedding": {**embedding, "hit_ratio": hit_ratio(embedding)},
+        "kb": {
+            name: {
+                "hit": kb.get(f"{name}:hit", 0),
+                "miss": kb.get(f"{name}:miss", 0),
+                "hit_ratio": hit_ratio(kb, f"{name}:hit", f"{name}:miss"),
+            }
+            for name in ("expand", "docs")
+        },
+        "mingli": {
+            name: {
+                "hit": mingli.get(f"{name}:hit", 0),
+                "miss": mingli.get(f"{name}:miss", 0),
+                "hit_ratio": hit_ratio(mingli, f"{name}:hit", f"{name}:miss"),
+            }
+            for name in sorted(tools)
+        },
+    }
+
+
 @router.websocket("/ws/{token}/{role:str}/{user_id:str}")
 async def websocket_endpoint_role(websocket: WebSocket, token: str, role: Optional[str] = None, user_id: Optional[str] = None):
     """ WebSocket 服务, 有特权"""
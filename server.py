@@ -1,32 +1,33 @@
 # 导入环境变量，必须放在最顶部
 import load_envs
 
-# 调试模式配置
-from langchain.globals import set_debug
-
-# 导入app实例
-from router import app
-
-from utils.db import init_db
-
 import os
 
-redis_host = os.getenv("REDIS_HOST")
+# 解析文档的进程池用 spawn 启动，子进程会把这个文件当作 __mp_main__ 重新导入，
+# 所以顶部只加载环境变量，app 和数据库初始化都放在下面，子进程不会导入整个服务
+if __name__ == "__main__":
+    import uvicorn
 
-if redis_host == '192.168.50.10':
-    import tracemalloc
+    from router import app
+    from utils.vector_store import get_backend
 
-    tracemalloc.start()
+    redis_host = os.getenv("REDIS_HOST")
 
-    # 设置调试模式
-    set_debug(False)
+    if redis_host == '192.168.50.10':
+        import tracemalloc
 
+        # 调试模式配置
+        from langchain.globals import set_debug
 
-# 创建数据库表, 如果表不存在的话
-init_db()
+        tracemalloc.start()
 
+        # 设置调试模式
+        set_debug(False)
 
-if __name__ == "__main__":
-    import uvicorn
+    # worker 数量，多个 worker 需要能被多个进程同时使用的向量数据库后端
+    workers = int(os.getenv("SERVER_WORKERS", "1"))
+    if workers > 1 and not get_backend().multiprocess:
+        raise RuntimeError("本地文件 qdrant 只能单进程使用，多个 worker 请配置 QDRANT_URL 或 VECTOR_BACKEND=flat")
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # 多个 worker 时 uvicorn 需要用导入路径启动，每个 worker 单独导入，worker 进程同样会先执行这个文件加载环境变量
+    uvicorn.run("router:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
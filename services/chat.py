@@ -1,6 +1,7 @@
 import os
 import uuid
 import asyncio
+from contextlib import aclosing
 from fastapi.responses import StreamingResponse
 from fastapi.websockets import WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPAuthorizationCredentials
@@ -9,35 +10,53 @@ from typing import Dict, Optional
 from services.guard import check_token
 from utils.custom_log import log
 from agents.master import Master
-from utils.oss import audio_exists
+from agents.voice import clean_text, submit_voice_job
+from agents.knowledge import query_expansion, search_mode as kb_search_mode
 
 
-def connect_ai(query: str, user_id: str):
-    """ 连接 AI 服务 """
-
-    # 创建 Master
-    master = Master(str(user_id))
+def connect_ai(query: str, user_id: str, on_audio=None, expand_query: Optional[bool] = None,
+               search_mode: Optional[str] = None):
+    """
+    连接 AI 服务, 传入 on_audio 时按句子流式合成语音，每合成好一段就回调一次。
+    expand_query 控制本次对话查询知识库时是否扩展问题，search_mode 是知识库检索模式，None 使用默认配置。
+    """
 
     # 生成唯一标识
     uid = str(uuid.uuid4())
 
-    # 运行查询
-    result = master.run(query)
+    async def predict():
+        # 本次对话的知识库检索设置，工具在线程里执行时会带上当前上下文
+        query_expansion.set(expand_query)
+        kb_search_mode.set(search_mode)
+
+        # 创建 Master, 会读取 redis 中的会话内存，放到线程里执行
+        master = await asyncio.to_thread(Master, str(user_id))
 
-    log.info("返回数据: %s", result)
+        # 句子级别的流式语音合成
+        pipeline = master.voice_pipeline(uid, on_audio) if on_audio else None
 
-    async def predict():
         text = ""
-        for _token in result:
-            # 检查 _token 的结构，并根据实际情况访问其内容
-            log.info("Token 数据: %s", _token)
-            token = _token.get('output', '')
-            yield token
-            text += token
+        try:
+            # 异步流式运行查询
+            async for token in master.astream(query):
+                yield token
+                text += token
+                if pipeline:
+                    pipeline.feed(token)
+        except BaseException:
+            # 回答出错或者客户端断开，取消还在合成的语音片段，不再向关闭的连接发送
+            if pipeline:
+                await pipeline.cancel()
+            raise
         log.info("返回文本: %s", text)
-        # 添加到后台任务, 去掉星号是避免语音读出来
-        asyncio.create_task(master.get_voice(
-            text.replace("*", "").replace("#", ""), uid))
+
+        if pipeline:
+            # 等待剩余的语音片段合成完成
+            count = await pipeline.close()
+            log.info("语音片段合成完成: %s", count)
+        else:
+            # 添加到后台任务, 去掉星号是避免语音读出来
+            submit_voice_job(master.get_voice(clean_text(text), uid))
 
     generate = predict()
 
@@ -71,6 +90,16 @@ async def connect_ws(websocket: WebSocket, token: str, role: Optional[str] = Non
     connected_clients[client_id] = websocket
     log.info("用户 %s 已连接", client_id)
 
+    async def send_audio(message_id: str, index: int, name: str):
+        """ 发送合成好的语音片段 """
+        data = {
+            "id": message_id,
+            "index": index,
+            "url": f"{os.getenv('OSS_ASSETS_URL')}/audio/{name}"
+        }
+        log.info("发送音频片段: %s", data)
+        await websocket.send_json(data)
+
     try:
         while True:
             # 接收数据
@@ -83,22 +112,18 @@ async def connect_ws(websocket: WebSocket, token: str, role: Optional[str] = Non
                 key = f"{client_id}_{tag_id}"
             log.info("用户 %s 的 key: %s", client_id, key)
 
-            # 连接 AI 服务
-            result = connect_ai(data, key)
+            # 连接 AI 服务, 语音按句子合成，第一句合成好就发送给客户端
+            result = connect_ai(data, key, send_audio)
 
-            # 发送数据给客户端
-            async for chunk in result["generate"]:
-                # 构建数据
-                data = {
-                    "id": result['id'],
-                    "message": chunk
-                }
-                await websocket.send_json(data)
-
-            # 异步执行，音频发送
-            task = asyncio.create_task(check_audio(
-                websocket, 'audio', result['id'], "mp3"))
-            await task
+            # 发送数据给客户端，发送失败时关闭生成器，取消还在合成的语音片段
+            async with aclosing(result["generate"]) as generate:
+                async for chunk in generate:
+                    # 构建数据
+                    data = {
+                        "id": result['id'],
+                        "message": chunk
+                    }
+                    await websocket.send_json(data)
 
     except WebSocketDisconnect:
         # 当客户端断开时，移除其连接
@@ -107,30 +132,3 @@ async def connect_ws(websocket: WebSocket, token: str, role: Optional[str] = Non
     finally:
         await websocket.close()
 
-
-async def check_audio(websocket: WebSocket, target_dir: str, filename: str, file_extension: str = "mp3"):
-    """ 检查音频是否存在并发送 """
-    while True:
-        # 检查音频是否存在
-        if audio_exists(target_dir, f"{filename}.{file_extension}"):
-            # 获取音频地址
-            oss_url = os.getenv("OSS_ASSETS_URL")
-            # 拼接完整地址
-            full_url = f"{oss_url}/{target_dir}/{filename}.{file_extension}"
-            # 判断 WebSocket 是否连接
-            if websocket.client is not None:
-                # 构建数据
-                data = {
-                    "id": filename,
-                    "url": full_url
-                }
-                log.info("发送音频数据: %s", data)
-                # 发送数据
-                await websocket.send_json(data)
-            else:
-                log.error("客户端已断开连接")
-                break
-            break
-
-        log.info("音频地址不存在，等待 1 秒钟...")
-        await asyncio.sleep(1)  # 使用asyncio.sleep(1)来等待1秒
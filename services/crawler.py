@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+import httpx
+
+from utils.custom_log import log
+from utils.db import redis_client
+from utils.http import connect_timeout, read_timeout
+
+# 同时抓取的网页数量
+crawl_concurrency = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+# 每个域名同时抓取的网页数量，避免给对方网站造成压力
+crawl_per_host = int(os.getenv("CRAWL_PER_HOST", "2"))
+# 单次抓取的网页数量上限
+crawl_max_pages = int(os.getenv("CRAWL_MAX_PAGES", "200"))
+# 网页抓取状态的保存时间，单位秒
+crawl_state_ttl = int(os.getenv("CRAWL_STATE_TTL", str(60 * 60 * 24 * 90)))
+
+
+@dataclass
+class Page:
+    """ 抓取到的网页 """
+    url: str
+    # 网页内容，没有变化的网页为 None
+    content: bytes | None = None
+    # 304 或者内容哈希没变
+    unchanged: bool = False
+    etag: str | None = None
+    last_modified: str | None = None
+    content_hash: str | None = None
+    # 网页上同一个域名的链接，按深度抓取时使用
+    links: list[str] = field(default_factory=list)
+
+
+class LinkParser(HTMLParser):
+    """ 提取网页上的链接 """
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self.links.append(href)
+
+
+def state_key(url: str) -> str:
+    """ 网页抓取状态在 redis 中的 key """
+    return f"crawl:page:{hashlib.sha1(url.encode('utf-8')).hexdigest()}"
+
+
+def get_state(url: str) -> dict:
+    """ 上次抓取时保存的 ETag、Last-Modified、内容哈希和链接 """
+    data = redis_client.hgetall(state_key(url))
+    return {key.decode("utf-8"): value.decode("utf-8") for key, value in data.items()}
+
+
+def save_states(pages: list[Page]):
+    """ 保存网页的抓取状态，网页学习成功后再保存，失败的网页下次会重新学习 """
+    pipe = redis_client.pipeline(transaction=False)
+    for page in pages:
+        key = state_key(page.url)
+        mapping = {
+            "etag": page.etag or "",
+            "last_modified": page.last_modified or "",
+            "content_hash": page.content_hash or "",
+            "links": json.dumps(page.links),
+        }
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, crawl_state_ttl)
+    pipe.execute()
+
+
+def normalize_url(base: str, href: str) -> str | None:
+    """ 转成绝对地址，去掉锚点，只保留 http 和 https """
+    url, _ = urldefrag(urljoin(base, href))
+    return url if urlsplit(url).scheme in ("http", "https") else None
+
+
+def extract_links(url: str, content: bytes) -> list[str]:
+    """ 提取网页上同一个域名的链接 """
+    parser = LinkParser()
+    try:
+        parser.feed(content.decode("utf-8", errors="ignore"))
+    except Exception as e:
+        log.error("解析网页链接出错: %s %s", url, e)
+    host = urlsplit(url).netloc
+    links = (normalize_url(url, href) for href in parser.links)
+    return list(dict.fromkeys(link for link in links if link and urlsplit(link).netloc == host))
+
+
+class Crawler:
+    """ 异步抓取网页，同一个域名的并发有上限，使用 ETag/Last-Modified 条件请求，内容没变的网页会跳过 """
+
+    def __init__(self, max_pages: int = crawl_max_pages):
+        self.max_pages = max_pages
+        self.semaphore = asyncio.Semaphore(crawl_concurrency)
+        self.host_semaphores: dict[str, asyncio.Semaphore] = {}
+        self.client: httpx.AsyncClient | None = None
+        self.failed: list[str] = []
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        """ 域名对应的并发限制 """
+        host = urlsplit(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(crawl_per_host)
+        return self.host_semaphores[host]
+
+    async def _get(self, url: str, headers: dict | None = None) -> httpx.Response:
+        """ 并发受限的 GET 请求 """
+        async with self.semaphore, self._host_semaphore(url):
+            return await self.client.get(url, headers=headers)
+
+    async def fetch(self, url: str, follow_links: bool) -> Page | None:
+        """ 条件请求网页，失败返回 None """
+        state = await asyncio.to_thread(get_state, url)
+        headers = {}
+        # 按深度抓取时需要上次保存的链接，没有保存链接(比如旧版本只在按深度抓取时提取)就不发条件请求，
+        # 内容没变的网页仍然按内容哈希跳过
+        if not (follow_links and not json.loads(state.get("links") or "[]")):
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        try:
+            response = await self._get(url, headers)
+        except httpx.HTTPError as e:
+            log.error("抓取网页出错: %s %s", url, e)
+            self.failed.append(url)
+            return None
+
+        if response.status_code == 304:
+            log.info("网页没有变化(304): %s", url)
+            return Page(url, unchanged=True, links=json.loads(state.get("links") or "[]"))
+
+        if response.status_code != 200:
+            log.error("抓取网页失败: %s %s", url, response.status_code)
+            self.failed.append(url)
+            return None
+
+        content = response.content
+        page = Page(
+            url,
+            content=content,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            content_hash=hashlib.sha256(content).hexdigest(),
+            # 不按深度抓取时也保存链接，之后按深度抓取时网页没有变化(304)也能继续沿着链接抓取
+            links=extract_links(url, content),
+        )
+        if page.content_hash == state.get("content_hash"):
+            log.info("网页内容没有变化: %s", url)
+            page.unchanged = True
+        return page
+
+    async def sitemap_urls(self, url: str, depth: int = 2) -> list[str]:
+        """ 读取 sitemap 中的网页地址，支持 sitemap 索引 """
+        try:
+            response = await self._get(url)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+        except (httpx.HTTPError, ET.ParseError) as e:
+            log.error("读取 sitemap 出错: %s %s", url, e)
+            self.failed.append(url)
+            return []
+
+        locs = [el.text.strip() for el in root.iter() if el.tag.endswith("loc") and el.text]
+        if not root.tag.endswith("sitemapindex"):
+            return locs
+        if depth <= 0:
+            return []
+        nested = await asyncio.gather(*(self.sitemap_urls(loc, depth - 1) for loc in locs))
+        return [item for urls in nested for item in urls]
+
+    async def crawl(self, urls: list[str], sitemap: str | None = None, depth: int = 0) -> list[Page]:
+        """ 从网页列表和 sitemap 开始抓取，depth 是沿着同一个域名的链接继续抓取的层数 """
+        timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as client:
+            self.client = client
+            seeds = list(urls)
+            if sitemap:
+                seeds += await self.sitemap_urls(sitemap)
+
+            pages: list[Page] = []
+            seen: set[str] = set()
+            level = [url for url in (normalize_url(seed, "") for seed in seeds) if url]
+            for current_depth in range(depth + 1):
+                level = [url for url in dict.fromkeys(level) if url not in seen][:self.max_pages - len(seen)]
+                if not level:
+                    break
+                seen.update(level)
+                follow = current_depth < depth
+                results = await asyncio.gather(*(self.fetch(url, follow) for url in level))
+                fetched = [page for page in results if page is not None]
+                pages.extend(fetched)
+                level = [link for page in fetched for link in page.links]
+            self.client = None
+        return pages
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from fastapi import HTTPException, status
+
+from utils.custom_log import log
+from utils.db import redis_client
+
+# 同时处理的学习任务数量，解析、总结和向量化都比较耗资源
+ingest_workers = int(os.getenv("INGEST_WORKERS", "2"))
+# 排队中的任务上限，超过后拒绝新的任务
+ingest_max_pending = int(os.getenv("INGEST_MAX_PENDING", "100"))
+# 任务状态保存时间，单位秒
+ingest_job_ttl = int(os.getenv("INGEST_JOB_TTL", str(60 * 60 * 24 * 7)))
+
+# 学习任务的线程池，任务不会占用请求的事件循环和线程
+ingest_executor = ThreadPoolExecutor(max_workers=ingest_workers, thread_name_prefix="ingest")
+# 还没完成的任务: 任务 id -> (任务, 状态, 清理函数)
+_futures: dict[str, tuple[Future, "IngestJob", Callable[[], None] | None]] = {}
+_futures_lock = threading.Lock()
+
+
+class IngestJob:
+    """ 学习任务的状态，保存在 redis 里，多个进程都可以查询 """
+
+    def __init__(self, job_id: str, kind: str, source: str, stages: list[str], meta: dict | None = None):
+        self.job_id = job_id
+        self.data = {
+            "id": job_id,
+            "kind": kind,
+            "source": source,
+            # 额外信息，比如文件的哈希和大小
+            "meta": meta or {},
+            "status": "queued",
+            "stage": None,
+            "error": None,
+            # 任务的执行结果，比如抓取了多少网页
+            "result": None,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+            "stages": {name: {"status": "pending", "started_at": None, "finished_at": None} for name in stages},
+        }
+
+    @staticmethod
+    def key(job_id: str) -> str:
+        """ 任务状态在 redis 中的 key """
+        return f"ingest:job:{job_id}"
+
+    def save(self):
+        """ 保存任务状态 """
+        self.data["updated_at"] = time.time()
+        redis_client.set(self.key(self.job_id), json.dumps(self.data, ensure_ascii=False), ex=ingest_job_ttl)
+
+    def start(self):
+        """ 开始执行 """
+        self.data["status"] = "running"
+        self.save()
+
+    def stage(self, name: str):
+        """ 进入下一个阶段，上一个阶段标记为完成 """
+        now = time.time()
+        current = self.data["stage"]
+        if current is not None:
+            self.data["stages"][current].update(status="done", finished_at=now)
+        self.data["stage"] = name
+        self.data["stages"].setdefault(name, {})
+        self.data["stages"][name].update(status="running", started_at=now, finished_at=None)
+        log.info("学习任务 %s 进入阶段: %s", self.job_id, name)
+        self.save()
+
+    def done(self, result=None):
+        """ 任务完成，result 是任务的执行结果 """
+        current = self.data["stage"]
+        if current is not None:
+            self.data["stages"][current].update(status="done", finished_at=time.time())
+        self.data["status"] = "done"
+        self.data["result"] = result
+        self.save()
+
+    def fail(self, error: str):
+        """ 任务失败 """
+        current = self.data["stage"]
+        if current is not None:
+            self.data["stages"][current].update(status="failed", finished_at=time.time())
+        self.data["status"] = "failed"
+        self.data["error"] = error
+        self.save()
+
+
+def get_job(job_id: str) -> dict | None:
+    """ 查询任务状态 """
+    data = redis_client.get(IngestJob.key(job_id))
+    return json.loads(data) if data else None
+
+
+def submit_job(kind: str, source: str, stages: list[str], func: Callable[[Callable[[str], None]], object],
+               cleanup: Callable[[], None] | None = None, **meta) -> str:
+    """
+    提交学习任务，立即返回任务 id。
+    func 接收一个 on_stage 回调，进入每个阶段时调用它，返回值会作为任务结果保存；cleanup 在任务结束后执行，比如删除临时文件。
+    meta 会保存到任务状态里。
+    """
+    with _futures_lock:
+        if len(_futures) >= ingest_max_pending:
+            if cleanup:
+                cleanup()
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="学习任务太多，请稍后再试"
+            )
+
+        job = IngestJob(uuid.uuid4().hex, kind, source, stages, meta)
+        job.save()
+
+        def run():
+            job.start()
+            try:
+                job.done(func(job.stage))
+                log.info("学习任务完成: %s", job.job_id)
+            except HTTPException as e:
+                log.error("学习任务失败: %s %s", job.job_id, e.detail)
+                job.fail(str(e.detail))
+            except Exception as e:
+                log.error("学习任务出错: %s %s", job.job_id, e)
+                job.fail(str(e))
+            finally:
+                if cleanup:
+                    cleanup()
+                with _futures_lock:
+                    _futures.pop(job.job_id, None)
+
+        _futures[job.job_id] = (ingest_executor.submit(run), job, cleanup)
+
+    log.info("提交学习任务: %s %s %s", job.job_id, kind, source)
+    return job.job_id
+
+
+def submit_task(name: str, func: Callable[[], object]) -> Future:
+    """ 在学习线程池里执行不需要记录状态的后台任务，比如启动时重建倒排索引，出错时记录到日志 """
+    def run():
+        try:
+            func()
+        except Exception as e:
+            log.error("后台任务出错: %s %s", name, e)
+
+    log.info("提交后台任务: %s", name)
+    return ingest_executor.submit(run)
+
+
+def shutdown_ingest():
+    """ 关闭服务时取消排队中的任务，正在执行的任务继续完成 """
+    with _futures_lock:
+        pending = list(_futures.items())
+    for job_id, (future, job, cleanup) in pending:
+        if future.cancel():
+            job.fail("服务关闭，任务已取消")
+            if cleanup:
+                cleanup()
+    ingest_executor.shutdown(wait=False)
@@ -1,14 +1,74 @@
 
+import asyncio
+import hashlib
 import os
+import tempfile
+from io import BytesIO
 from fastapi import HTTPException, UploadFile, status
 from langchain_text_splitters import HTMLHeaderTextSplitter
 from utils.custom_log import log
 from utils.save_docs import SaveDocs
-from utils.chains import save_texts, split_texts, get_stuff_chain
+from utils.chains import index_documents, need_summary, split_documents
+from services.ingest import submit_job
+from services.crawler import Crawler, save_states
+
+# 文件学习的阶段: 解析、总结(可选)、向量化存储
+file_stages = ["load", "summarize", "save"] if need_summary() else ["load", "save"]
+# 网页学习的阶段: 抓取、总结(可选)、向量化存储
+url_stages = ["crawl", "summarize", "save"] if need_summary() else ["crawl", "save"]
+
+# 网页按标题切割
+headers_to_split_on = [
+    ("h1", "Header 1"),
+    ("h2", "Header 2"),
+    ("h3", "Header 3"),
+    ("h4", "Header 4"),
+    ("p", "p"),
+]
+
+# 上传文件每次读取的大小，单位字节
+upload_chunk_size = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# 上传文件的大小上限，单位字节
+upload_max_size = int(os.getenv("UPLOAD_MAX_SIZE", str(50 * 1024 * 1024)))
+# 上传文件的临时目录，默认使用系统临时目录
+upload_dir = os.getenv("UPLOAD_DIR") or None
+
+
+def _too_large() -> HTTPException:
+    """ 文件超过大小上限 """
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"文件不能超过 {upload_max_size // 1024 // 1024}MB"
+    )
+
+
+async def save_upload(file: UploadFile, extension: str) -> tuple[str, str, int]:
+    """
+    分块把上传的文件写到唯一的临时文件，不会把整个文件读进内存，边写边计算 sha256。
+    返回临时文件路径、文件哈希和文件大小，超过大小上限时删除临时文件并报错。
+    """
+    if file.size is not None and file.size > upload_max_size:
+        raise _too_large()
+
+    fd, path = tempfile.mkstemp(prefix="upload_", suffix=f".{extension}", dir=upload_dir)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            while chunk := await file.read(upload_chunk_size):
+                size += len(chunk)
+                if size > upload_max_size:
+                    raise _too_large()
+                digest.update(chunk)
+                await asyncio.to_thread(out_file.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest(), size
 
 
 async def save_file(file: UploadFile):
-    """ 添加文件，直接学习文件中的数据 """
+    """ 添加文件，保存到临时文件后提交学习任务，立即返回任务 id """
     log.info("添加文件 %s", file.filename)
 
     # 实例化保存文档的工具类
@@ -21,61 +81,85 @@ async def save_file(file: UploadFile):
             detail="不支持的文件类型"
         )
 
-    # 存储PDF文件到临时文件
-    temp_file_path = f"temp_{file.filename}"
-    with open(temp_file_path, "wb") as out_file:
-        out_file.write(await file.read())
-
-    try:
-        # 保存文档
-        save_docs.save(temp_file_path)
-
-        # 删除临时文件
-        os.remove(temp_file_path)
+    # 分块存储到唯一的临时文件, 解析时直接读取这个文件
+    temp_file_path, sha256, size = await save_upload(file, save_docs.get_file_extension(file.filename))
+    log.info("文件已保存: %s, 大小: %s, sha256: %s", temp_file_path, size, sha256)
 
-        log.info("文件保存成功")
-        return {"ok": "文件保存成功"}
-    except Exception as e:
+    def cleanup():
         # 删除临时文件
-        os.remove(temp_file_path)
-        raise e
-
-
-def add_url(url: str):
-    """ 添加网页链接，直接学习网页上的数据 """
-    log.info("保存网页 %s", url)
-
-    # 文本分割
-    headers_to_split_on = [
-        ("h1", "Header 1"),
-        ("h2", "Header 2"),
-        ("h3", "Header 3"),
-        ("h4", "Header 4"),
-        ("p", "p"),
-    ]
-    html_splitter = HTMLHeaderTextSplitter(
-        headers_to_split_on=headers_to_split_on)
-
-    documents = html_splitter.split_text_from_url(url)
-
-    chain = get_stuff_chain()
-
-    docs = chain.invoke(documents)
-
-    log.info('合并文档后的文本: %s', docs)
-
-    # 在此分割文档
-    texts = split_texts(docs["output_text"])
-
-    # 保存文档
-    result = save_texts(texts)
-
-    if not result:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+    # 解析、总结和向量化放到后台执行
+    job_id = submit_job(
+        "file",
+        file.filename,
+        file_stages,
+        lambda on_stage: save_docs.save(
+            temp_file_path, on_stage, {"source": file.filename, "type": "file", "sha256": sha256}),
+        cleanup,
+        sha256=sha256,
+        size=size,
+    )
+    log.info("文件已提交学习: %s", job_id)
+    return {"ok": "文件已提交学习", "job_id": job_id}
+
+
+def add_url(urls: list[str], sitemap: str | None = None, depth: int = 0):
+    """ 添加网页链接或者 sitemap，提交学习任务，立即返回任务 id """
+    if not urls and not sitemap:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="请提供网页链接或者 sitemap"
+        )
+    source = sitemap or urls[0]
+    log.info("提交网页学习 %s, sitemap: %s, 深度: %s", urls, sitemap, depth)
+    job_id = submit_job(
+        "url",
+        source,
+        url_stages,
+        lambda on_stage: save_urls(urls, sitemap, depth, on_stage),
+        urls=urls,
+        sitemap=sitemap,
+        depth=depth,
+    )
+    return {"ok": "网页已提交学习", "job_id": job_id}
+
+
+def save_urls(urls: list[str], sitemap: str | None = None, depth: int = 0, on_stage=lambda name: None) -> dict:
+    """
+    抓取并学习网页上的数据，on_stage 在进入每个阶段时调用。
+    没有变化的网页(304 或者内容哈希相同)不会再次总结和向量化，返回抓取的统计。
+    """
+    on_stage("crawl")
+    crawler = Crawler()
+    pages = asyncio.run(crawler.crawl(urls, sitemap, depth))
+    changed = [page for page in pages if not page.unchanged]
+    result = {
+        "fetched": len(pages),
+        "unchanged": len(pages) - len(changed),
+        "changed": len(changed),
+        "failed": crawler.failed,
+    }
+    log.info("网页抓取完成: %s", result)
+
+    html_splitter = HTMLHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
+    documents = []
+    for page in changed:
+        # 按标题切出来的段落可能很长，再切成适合检索的大小
+        for doc in split_documents(html_splitter.split_text_from_file(BytesIO(page.content)), "url"):
+            doc.metadata["source"] = page.url
+            documents.append(doc)
+
+    # 按学习模式总结和保存文档
+    if documents and not index_documents(documents, {"type": "url"}, on_stage):
         log.error("保存网页失败")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="保存网页失败"
         )
-    else:
-        log.info("保存网页成功")
-        return {"ok": "保存网页成功"}
+
+    # 学习成功后再记录抓取状态，下次没有变化的网页可以跳过，304 的网页状态不变
+    save_states([page for page in pages if page.content is not None])
+    log.info("保存网页成功")
+    return result
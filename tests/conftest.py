@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# 日志模块导入时就会打开日志文件，测试时写到临时目录
+os.environ.setdefault("LOG_PATH", os.path.join(tempfile.gettempdir(), "ai_test.log"))
@@ -0,0 +1,159 @@
+import os
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from utils.flat_index import FlatIndexBackend, manifests_dir, merge_plan, segments_dir
+
+
+def make_items(prefix: str, count: int, dim: int = 8, seed: int = 0):
+    """ 生成文本块和随机向量 """
+    rng = np.random.default_rng(seed)
+    items = [(f"{prefix}-{i}", Document(page_content=f"{prefix} {i}", metadata={"i": i})) for i in range(count)]
+    return items, rng.normal(size=(count, dim)).tolist()
+
+
+def write(backend: FlatIndexBackend, items, vectors):
+    with backend.writer() as writer:
+        writer.add(items, vectors)
+
+
+def test_second_instance_sees_published_snapshot(tmp_path):
+    writer_backend = FlatIndexBackend(str(tmp_path))
+    reader_backend = FlatIndexBackend(str(tmp_path))
+    assert reader_backend.snapshot() is None
+
+    items, vectors = make_items("a", 5)
+    write(writer_backend, items, vectors)
+    snapshot = reader_backend.snapshot()
+    assert snapshot is not None and snapshot.count == 5
+
+    # 后续写入在已经打开过快照的实例里也能看到，之前的文本块不会重复写入
+    more, more_vectors = make_items("b", 3, seed=1)
+    with writer_backend.writer() as writer:
+        assert writer.exists([id_ for id_, _ in items + more]) == {id_ for id_, _ in items}
+        writer.add(more, more_vectors)
+    assert reader_backend.snapshot().count == 8
+
+    hits = reader_backend.search([more_vectors[0]], 1)[0]
+    assert hits[0].id == "b-0"
+    assert hits[0].document.page_content == "b 0"
+    assert hits[0].score == pytest.approx(1.0, abs=1e-5)
+
+
+def test_search_matches_brute_force(tmp_path, monkeypatch):
+    # 小的分块大小，覆盖分块合并的逻辑
+    monkeypatch.setattr("utils.flat_index.flat_search_block", 7)
+    backend = FlatIndexBackend(str(tmp_path))
+    items, vectors = make_items("a", 50)
+    write(backend, items, vectors)
+
+    queries = np.random.default_rng(2).normal(size=(3, 8))
+    matrix = np.asarray(vectors) / np.linalg.norm(vectors, axis=1, keepdims=True)
+    for query, hits in zip(queries, backend.search(queries.tolist(), 5)):
+        expected = np.argsort(-(matrix @ (query / np.linalg.norm(query))))[:5]
+        assert [hit.id for hit in hits] == [items[row][0] for row in expected]
+
+
+def test_failed_session_publishes_nothing(tmp_path):
+    backend = FlatIndexBackend(str(tmp_path))
+    items, vectors = make_items("a", 2)
+    with pytest.raises(RuntimeError):
+        with backend.writer() as writer:
+            writer.add(items, vectors)
+            raise RuntimeError("embedding failed")
+    assert backend.snapshot() is None
+
+
+def test_publish_only_writes_the_new_segment(tmp_path, monkeypatch):
+    monkeypatch.setattr("utils.flat_index.flat_merge_factor", 0)
+    backend = FlatIndexBackend(str(tmp_path))
+    items, vectors = make_items("a", 5)
+    write(backend, items, vectors)
+    first = os.listdir(tmp_path / segments_dir)
+    stat = os.stat(tmp_path / segments_dir / first[0] / "vectors.f32")
+
+    more, more_vectors = make_items("b", 3, seed=1)
+    write(backend, more, more_vectors)
+    snapshot = backend.snapshot()
+    assert [segment.count for segment in snapshot.segments] == [5, 3]
+    # 已有的段没有被复制或者修改
+    assert snapshot.segments[0].name == first[0]
+    assert os.stat(tmp_path / segments_dir / first[0] / "vectors.f32").st_mtime_ns == stat.st_mtime_ns
+
+
+def test_cleanup_keeps_segments_of_kept_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr("utils.flat_index.flat_keep_snapshots", 2)
+    monkeypatch.setattr("utils.flat_index.flat_merge_factor", 0)
+    backend = FlatIndexBackend(str(tmp_path))
+    for i in range(4):
+        items, vectors = make_items(f"v{i}", 2, seed=i)
+        write(backend, items, vectors)
+
+    assert len(os.listdir(tmp_path / manifests_dir)) == 2
+    assert len(os.listdir(tmp_path / segments_dir)) == 4
+    assert FlatIndexBackend(str(tmp_path)).snapshot().count == 8
+
+
+def test_merge_plan_keeps_segments_geometric():
+    assert merge_plan([10], 2) is None
+    assert merge_plan([1, 1], 2) == 0
+    assert merge_plan([2, 1], 2) is None
+    assert merge_plan([2, 1, 1], 2) == 0
+    assert merge_plan([100, 2, 1, 1], 2) == 1
+    assert merge_plan([1, 1], 0) is None
+
+
+def test_compaction_keeps_search_results(tmp_path, monkeypatch):
+    monkeypatch.setattr("utils.flat_index.flat_merge_factor", 0)
+    backend = FlatIndexBackend(str(tmp_path))
+    all_items, all_vectors = [], []
+    for i in range(5):
+        items, vectors = make_items(f"v{i}", 4, seed=i)
+        write(backend, items, vectors)
+        all_items += items
+        all_vectors += vectors
+    queries = np.random.default_rng(9).normal(size=(2, 8)).tolist()
+    before = [[hit.id for hit in hits] for hits in backend.search(queries, 6)]
+
+    monkeypatch.setattr("utils.flat_index.flat_merge_factor", 2)
+    while backend.compact():
+        pass
+    snapshot = backend.snapshot()
+    assert len(snapshot.segments) == 1
+    assert snapshot.count == 20
+    assert [[hit.id for hit in hits] for hits in backend.search(queries, 6)] == before
+    assert snapshot.segments[0].document(7).page_content == all_items[7][1].page_content
+    reader = FlatIndexBackend(str(tmp_path))
+    assert sorted(id_ for batch in reader.scroll(3) for id_, _ in batch) == sorted(id_ for id_, _ in all_items)
+
+
+def test_background_compaction_after_publish(tmp_path):
+    backend = FlatIndexBackend(str(tmp_path))
+    for i in range(4):
+        items, vectors = make_items(f"v{i}", 2, seed=i)
+        write(backend, items, vectors)
+        if backend._compactor is not None:
+            backend._compactor.join()
+    snapshot = backend.snapshot()
+    assert snapshot.count == 8
+    assert len(snapshot.segments) == 1
+    backend.close()
+
+
+def test_concurrent_sessions_skip_duplicates(tmp_path):
+    first_backend = FlatIndexBackend(str(tmp_path))
+    second_backend = FlatIndexBackend(str(tmp_path))
+    items, vectors = make_items("a", 4)
+    more, more_vectors = make_items("b", 2, seed=1)
+
+    # 两个会话同时打开，都没有看到对方的写入
+    with first_backend.writer() as first:
+        with second_backend.writer() as second:
+            second.add(items[:2] + more, vectors[:2] + more_vectors)
+        first.add(items, vectors)
+
+    snapshot = FlatIndexBackend(str(tmp_path)).snapshot()
+    assert snapshot.count == 6
+    assert sorted(id_ for segment in snapshot.segments for id_ in segment.ids) == sorted(id_ for id_, _ in items + more)
@@ -1,15 +1,30 @@
 # 使用预封装好的 chain
 from langchain.chains.summarize import load_summarize_chain
+from langchain.chains.summarize.map_reduce_prompt import PROMPT as map_reduce_prompt
+from langchain_core.output_parsers import StrOutputParser
 from langchain_openai import ChatOpenAI
-from langchain_text_splitters import CharacterTextSplitter
 from langchain_core.documents import Document
-from langchain_community.vectorstores.qdrant import Qdrant
-from langchain_openai import OpenAIEmbeddings
 import os
+from typing import Callable, Iterable
 
 
 from utils.custom_log import log
-from chat_consts import qdrant_path
+from utils.embeddings import get_embeddings
+from utils.parse import get_text_splitter
+from utils.tokens import count_tokens
+from utils.vector_store import VectorSession, ingesting, upsert_documents, upsert_texts
+
+# 学习模式: raw 直接索引原始文本块; summary 先总结再索引总结(旧的方式)
+ingest_mode = os.getenv("INGEST_MODE", "raw")
+# raw 模式下是否额外生成总结，总结作为额外的文本块写入
+ingest_summary = os.getenv("INGEST_SUMMARY", "false").lower() in ("1", "true", "yes")
+# 总结时同时请求 llm 的数量
+ingest_concurrency = int(os.getenv("INGEST_CONCURRENCY", "8"))
+
+
+def need_summary() -> bool:
+    """ 学习时是否需要总结 """
+    return ingest_mode == "summary" or ingest_summary
 
 
 def get_stuff_chain(verbose: bool = False):
@@ -35,61 +50,137 @@ def get_map_reduce_chain(token_max: int = 4000, verbose: bool = False):
     return map_reduce_chain
 
 
-def split_texts(text: str) -> list[str]:
-    """ 获取文档列表 """
-    # 定义一个文本切割器
-    text_splitter = CharacterTextSplitter(
-        chunk_size=4000,  # 每个分割块的大小, 太小会导致分割块过多，大文件的语义处理会变慢
-        chunk_overlap=100,  # 分割块之间的重叠大小
-        length_function=len,  # 用于计算文本长度的函数
-        add_start_index=True,  # 是否在分割块中添加起始索引
-    )
-    texts = text_splitter.split_text(text)
-    return texts
-
-
-def split_documents(text: str) -> list[Document]:
-    """ 获取文档列表 """
-    # 定义一个文本切割器
-    text_splitter = CharacterTextSplitter(
-        chunk_size=4000,  # 每个分割块的大小, 太小会导致分割块过多，大文件的语义处理会变慢
-        chunk_overlap=100,  # 分割块之间的重叠大小
-        length_function=len,  # 用于计算文本长度的函数
-        add_start_index=True,  # 是否在分割块中添加起始索引
-    )
-    documents = text_splitter.split_documents(text)
-    return documents
+def get_summary_chain():
+    """ 总结用的 chain，map 和 reduce 阶段使用同一个提示词 """
+    llm = ChatOpenAI(temperature=0, model=os.getenv('OPENAI_MODEL'))
+    return map_reduce_prompt | llm | StrOutputParser()
+
+
+def map_summaries(documents: list[Document], concurrency: int = ingest_concurrency) -> list[str]:
+    """ map 阶段，每个文本块同时总结，并发数量有上限 """
+    if not documents:
+        return []
+    summaries = get_summary_chain().batch(
+        [{"text": doc.page_content} for doc in documents], config={"max_concurrency": concurrency})
+    log.info("map 总结完成: %s 个文本块", len(summaries))
+    return summaries
+
+
+def reduce_summaries(summaries: list[str], concurrency: int = ingest_concurrency, token_max: int = 4000) -> str:
+    """ reduce 阶段，把总结按 token_max 分组合并，直到只剩一个 """
+    chain = get_summary_chain()
+    config = {"max_concurrency": concurrency}
+    while len(summaries) > 1:
+        # 按 token 数量分组，每组合并成一个总结
+        groups, group, size = [], [], 0
+        for summary in summaries:
+            tokens = count_tokens(summary)
+            if group and size + tokens > token_max:
+                groups.append(group)
+                group, size = [], 0
+            group.append(summary)
+            size += tokens
+        groups.append(group)
+        if len(groups) == len(summaries):
+            # 单个总结已经超过上限，没法再分组，直接全部合并
+            groups = [summaries]
+
+        summaries = chain.batch([{"text": "\n\n".join(group)} for group in groups], config=config)
+        log.info("reduce 总结完成: 剩余 %s 个总结", len(summaries))
+
+    return summaries[0] if summaries else ""
 
 
-def save_texts(texts: list[str]) -> bool:
-    """ 保存文档到向量数据库 """
+def summarize_documents(documents: list[Document], concurrency: int = ingest_concurrency,
+                        token_max: int = 4000) -> str:
+    """ 并发的 map reduce 总结 """
+    return reduce_summaries(map_summaries(documents, concurrency), concurrency, token_max)
+
+
+def split_texts(text: str, profile: str = "summary") -> list[str]:
+    """ 获取文档列表，profile 是切割参数 """
+    return get_text_splitter(profile).split_text(text)
+
+
+def split_documents(text: list[Document], profile: str = "default") -> list[Document]:
+    """ 获取文档列表，profile 是切割参数 """
+    return get_text_splitter(profile).split_documents(text)
+
+
+def save_texts(texts: list[str], metadata: dict | None = None) -> bool:
+    """ 保存文档到向量数据库，只写入新的文本块，metadata 是来源信息 """
     try:
-        embedding = OpenAIEmbeddings(model=os.getenv('OPENAI_MODEL'))
-        # 引入向量数据库
-        Qdrant.from_texts(
-            texts=texts,
-            embedding=embedding,
-            path=qdrant_path(),
-            collection_name="local_documents"
-        )
+        # 带缓存的向量化工具，重复的文本不会再次请求接口
+        embedding = get_embeddings(os.getenv('OPENAI_MODEL'))
+        # 按内容哈希增量写入
+        upsert_texts(texts, embedding, metadata)
         return True
     except Exception as exc:
         log.error('向量化与向量存储出错: %s', exc)
         return False
 
 
-def save_documents(documents: list[Document]) -> bool:
-    """ 保存文档到向量数据库 """
+def save_documents(documents: list[Document], session: VectorSession | None = None) -> bool:
+    """ 保存文档到向量数据库，只写入新的文本块，session 是学习任务的写入会话，不传时单独打开一次 """
     try:
-        embedding = OpenAIEmbeddings(model=os.getenv('OPENAI_MODEL'))
-        # 引入向量数据库
-        Qdrant.from_documents(
-            documents=documents,
-            embedding=embedding,
-            path=qdrant_path(),
-            collection_name="local_documents"
-        )
+        # 带缓存的向量化工具，重复的文本不会再次请求接口
+        embedding = get_embeddings(os.getenv('OPENAI_MODEL'))
+        # 按内容哈希增量写入，文档的 metadata 作为来源信息
+        if session is None:
+            upsert_documents(documents, embedding)
+        else:
+            session.upsert(documents, embedding)
         return True
     except Exception as exc:
         log.error('向量化与向量存储出错: %s', exc)
         return False
+
+
+def index_batches(batches: Iterable[list[Document]], metadata: dict | None = None,
+                  on_stage: Callable[[str], None] | None = None) -> bool:
+    """
+    按学习模式分批写入知识库，每批解析出来就写入，不需要把整个文档放在内存里。
+    raw 模式直接写入原始文本块，开启总结时总结作为额外的文本块写入；summary 模式只写入总结。
+    需要总结时每批先做 map 总结，只保留较短的总结，所有批次完成后再 reduce。
+    metadata 是来源信息，on_stage 在进入每个阶段时调用。
+    """
+    on_stage = on_stage or (lambda name: None)
+    metadata = metadata or {}
+
+    summaries = []
+    count = 0
+    # 整个任务只打开一次写入会话，每批只做向量化和写入，任务结束后一起生效
+    with ingesting() as session:
+        for documents in batches:
+            if not count:
+                # summary 模式先总结，所有总结完成后才写入
+                on_stage("save" if ingest_mode == "raw" else "summarize")
+            count += len(documents)
+            if ingest_mode == "raw":
+                points = [
+                    Document(page_content=doc.page_content, metadata={**doc.metadata, **metadata, "kind": "chunk"})
+                    for doc in documents
+                ]
+                if not save_documents(points, session):
+                    return False
+            if need_summary():
+                summaries += map_summaries(documents)
+        log.info("写入文档完成: %s 个文本块", count)
+
+        if need_summary() and summaries:
+            if ingest_mode == "raw":
+                on_stage("summarize")
+            summary = reduce_summaries(summaries)
+            log.info('合并文档后的文本: %s', summary)
+            on_stage("save")
+            return save_documents([
+                Document(page_content=text, metadata={**metadata, "kind": "summary"})
+                for text in split_texts(summary)
+            ], session)
+    return True
+
+
+def index_documents(documents: list[Document], metadata: dict | None = None,
+                    on_stage: Callable[[str], None] | None = None) -> bool:
+    """ 按学习模式写入知识库，documents 是一个文档的所有文本块 """
+    return index_batches([documents], metadata, on_stage)
@@ -1,5 +1,6 @@
 import os
 import redis
+import redis.asyncio
 import json
 from sqlalchemy import create_engine, orm
 from utils.custom_log import log
@@ -24,6 +25,13 @@ redis_client = redis.Redis(
     db=os.getenv("REDIS_DB"),
     password=os.getenv("REDIS_PASSWORD")
 )
+# 异步 Redis 连接，给事件循环里的代码使用
+async_redis_client = redis.asyncio.Redis(
+    host=os.getenv("REDIS_HOST"),
+    port=os.getenv("REDIS_PORT"),
+    db=os.getenv("REDIS_DB"),
+    password=os.getenv("REDIS_PASSWORD")
+)
 # 注意： 由于项目时间关系，我就不精细化处理内存数据了，有任何改动，对应 key 的数据会全部清理掉。
 # 比如列表的数据变动，我会把整个列表从 redis 清空。不会精细的修改内存数据。
 
@@ -0,0 +1,111 @@
+import hashlib
+import os
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from utils.custom_log import log
+from utils.db import async_redis_client, redis_client
+from utils.stats import aincr_stat, incr_stat
+
+# 向量缓存时间，单位秒，相同的文本和模型得到的向量是一样的
+embedding_cache_ttl = int(os.getenv("EMBEDDING_CACHE_TTL", str(60 * 60 * 24 * 30)))
+
+
+def pack_vector(vector: list[float]) -> bytes:
+    """ 向量压缩成 float32 字节，比 json 小很多 """
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def unpack_vector(data: bytes) -> list[float]:
+    """ float32 字节还原成向量 """
+    return np.frombuffer(data, dtype=np.float32).tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """ 带 redis 缓存的向量化工具，按模型名称和文本哈希缓存，批量读写都只有一次往返 """
+
+    def __init__(self, embeddings: OpenAIEmbeddings):
+        self.embeddings = embeddings
+        self.model = embeddings.model
+
+    def cache_key(self, text: str) -> str:
+        """ 缓存 key，只和模型名称以及文本内容有关 """
+        return f"emb:{self.model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def _merge(self, texts: list[str], cached: list[bytes | None]) -> tuple[list, list[int]]:
+        """ 还原命中的向量，返回结果列表和未命中的下标 """
+        vectors = [unpack_vector(item) if item is not None else None for item in cached]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        log.info("向量缓存: 命中 %s, 未命中 %s", len(texts) - len(missing), len(missing))
+        return vectors, missing
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """ 批量向量化，只请求缓存里没有的文本 """
+        if not texts:
+            return []
+        keys = [self.cache_key(text) for text in texts]
+        vectors, missing = self._merge(texts, redis_client.mget(keys))
+
+        if missing:
+            # 同一批里重复的文本只请求一次
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            embedded = dict(zip(unique, self.embeddings.embed_documents(unique)))
+            pipe = redis_client.pipeline(transaction=False)
+            for text, vector in embedded.items():
+                pipe.set(self.cache_key(text), pack_vector(vector), ex=embedding_cache_ttl)
+            for i in missing:
+                vectors[i] = embedded[texts[i]]
+            pipe.execute()
+
+        incr_stat("embedding", "hit", len(texts) - len(missing))
+        incr_stat("embedding", "miss", len(missing))
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        """ 向量化查询 """
+        key = self.cache_key(text)
+        cached = redis_client.get(key)
+        if cached is not None:
+            incr_stat("embedding", "hit")
+            return unpack_vector(cached)
+        incr_stat("embedding", "miss")
+
+        vector = self.embeddings.embed_query(text)
+        redis_client.set(key, pack_vector(vector), ex=embedding_cache_ttl)
+        return vector
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        """ 异步批量向量化 """
+        if not texts:
+            return []
+        keys = [self.cache_key(text) for text in texts]
+        vectors, missing = self._merge(texts, await async_redis_client.mget(keys))
+
+        if missing:
+            # 同一批里重复的文本只请求一次
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            embedded = dict(zip(unique, await self.embeddings.aembed_documents(unique)))
+            pipe = async_redis_client.pipeline(transaction=False)
+            for text, vector in embedded.items():
+                pipe.set(self.cache_key(text), pack_vector(vector), ex=embedding_cache_ttl)
+            for i in missing:
+                vectors[i] = embedded[texts[i]]
+            await pipe.execute()
+
+        await aincr_stat("embedding", "hit", len(texts) - len(missing))
+        await aincr_stat("embedding", "miss", len(missing))
+        return vectors
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """ 异步向量化查询 """
+        return (await self.aembed_documents([text]))[0]
+
+
+@lru_cache(maxsize=None)
+def get_embeddings(model: str | None = None) -> CachedEmbeddings:
+    """ 获取共享的向量化工具，不传模型名称时使用默认模型 """
+    embeddings = OpenAIEmbeddings(model=model) if model else OpenAIEmbeddings()
+    return CachedEmbeddings(embeddings)
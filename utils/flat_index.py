@@ -0,0 +1,524 @@
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+from langchain_core.documents import Document
+
+from chat_consts import qdrant_path
+from utils.custom_log import log
+from utils.vector_backend import Hit, VectorBackend, VectorWriter
+
+# 平铺索引的目录，多个进程共享
+flat_index_path = os.getenv("FLAT_INDEX_PATH") or qdrant_path("local_flat_index")
+# 检索时每次参与矩阵乘法的行数，限制临时内存
+flat_search_block = int(os.getenv("FLAT_SEARCH_BLOCK", "65536"))
+# 保留的旧快照数量，正在切换快照的读取进程还可能打开它们
+flat_keep_snapshots = int(os.getenv("FLAT_KEEP_SNAPSHOTS", "2"))
+# 合并段的倍数: 较早的段小于后面的段合计的这个倍数时合并，段的数量保持在对数级别，0 表示不自动合并
+flat_merge_factor = int(os.getenv("FLAT_MERGE_FACTOR", "2"))
+
+# 目录结构:
+# CURRENT -> 当前快照的名称，写入新快照后原子替换
+# write.lock -> 写入锁，同一时间只有一个进程发布快照
+# compact.lock -> 合并锁，同一时间只有一个进程合并段
+# manifests/{名称}.json -> 快照: {dim: 向量维度, segments: [{name: 段名称, count: 文本块数量}]}
+# segments/{名称}/ -> 段，写入后不再修改，多个快照共用
+# segments/{名称}/meta.json -> {dim: 向量维度, count: 文本块数量}
+# segments/{名称}/vectors.f32 -> count x dim 的 float32 矩阵，每行已经归一化，点积就是余弦相似度
+# segments/{名称}/ids.txt -> 文本块 id，一行一个
+# segments/{名称}/docs.jsonl -> 文本块内容和 metadata，一行一个
+# segments/{名称}/offsets.u64 -> count + 1 个 uint64，docs.jsonl 中每一行的起始位置
+# 每次写入只新增一个段和一个快照，写入的成本和新增的文本块数量成正比；小的段在后台合并
+current_name = "CURRENT"
+lock_name = "write.lock"
+compact_lock_name = "compact.lock"
+manifests_dir = "manifests"
+segments_dir = "segments"
+# 还没写完的段和快照，发布时是 .tmp-，合并时是 .merge-
+tmp_prefix = ".tmp-"
+merge_prefix = ".merge-"
+# 合并时每次复制的字节数
+copy_block = 16 * 1024 * 1024
+
+
+def normalize(vectors) -> np.ndarray:
+    """ 转成 float32 并按行归一化 """
+    matrix = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _fsync_dir(path: str):
+    """ 目录的 fsync，保证重命名写入磁盘 """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _new_name() -> str:
+    """ 段和快照的名称，按时间排序 """
+    return f"{time.time_ns()}-{os.getpid()}-{threading.get_ident()}"
+
+
+def merge_plan(counts: list[int], factor: int | None = None) -> int | None:
+    """
+    返回需要合并的段的起始位置，从这里到最后的段合并成一个，不需要合并时返回 None。
+    较早的段小于后面的段合计的 factor 倍时一起合并，每个文本块只会被合并对数次。
+    """
+    factor = flat_merge_factor if factor is None else factor
+    if factor <= 0 or len(counts) < 2:
+        return None
+    start, total = len(counts) - 1, counts[-1]
+    while start > 0 and counts[start - 1] < factor * total:
+        start -= 1
+        total += counts[start]
+    return start if start < len(counts) - 1 else None
+
+
+class FlatSegment:
+    """ 只读的段，向量和文本块内容都用内存映射，多个进程共享操作系统的页缓存 """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.dim: int = meta["dim"]
+        self.count: int = meta["count"]
+        with open(os.path.join(path, "ids.txt"), encoding="utf-8") as f:
+            self.ids = f.read().split()
+        self.rows = {id_: row for row, id_ in enumerate(self.ids)}
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                                 shape=(self.count, self.dim))
+        self.offsets = np.memmap(os.path.join(path, "offsets.u64"), dtype=np.uint64, mode="r")
+        with open(os.path.join(path, "docs.jsonl"), "rb") as f:
+            self.docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def document(self, row: int) -> Document:
+        """ 读取一行文本块 """
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return Document(**json.loads(self.docs[start:end]))
+
+    def search(self, queries: np.ndarray, limit: int) -> tuple[np.ndarray, np.ndarray]:
+        """ 分块做矩阵乘法，返回 (相似度, 行号)，都是 (结果数量, 问题数量) 的矩阵，没有排序 """
+        scores_parts, rows_parts = [], []
+        for start in range(0, self.count, flat_search_block):
+            # (块内行数, 问题数量)
+            scores = np.asarray(self.vectors[start:start + flat_search_block]) @ queries.T
+            top = min(limit, len(scores))
+            rows = np.argpartition(-scores, top - 1, axis=0)[:top]
+            scores_parts.append(np.take_along_axis(scores, rows, axis=0))
+            rows_parts.append(rows + start)
+        return np.concatenate(scores_parts), np.concatenate(rows_parts)
+
+    def close(self):
+        self.docs.close()
+
+
+class FlatSnapshot:
+    """ 只读快照，由快照清单里的多个段组成 """
+
+    def __init__(self, name: str, dim: int, segments: list[FlatSegment]):
+        self.name = name
+        self.dim = dim
+        self.segments = segments
+        self.count = sum(segment.count for segment in segments)
+
+    def contains(self, id_: str) -> bool:
+        """ 文本块是否已经存在 """
+        return any(id_ in segment.rows for segment in self.segments)
+
+    def search(self, queries: np.ndarray, limit: int) -> list[list[tuple[FlatSegment, int, float]]]:
+        """ 每个段分别检索再合并，每个问题返回 (段, 行号, 相似度)，按相似度从高到低排列 """
+        if not self.count or limit <= 0:
+            return [[] for _ in queries]
+        scores_parts, rows_parts, owners_parts = [], [], []
+        for index, segment in enumerate(self.segments):
+            scores, rows = segment.search(queries, limit)
+            scores_parts.append(scores)
+            rows_parts.append(rows)
+            owners_parts.append(np.full(rows.shape, index))
+        scores = np.concatenate(scores_parts)
+        rows = np.concatenate(rows_parts)
+        owners = np.concatenate(owners_parts)
+        order = np.argsort(-scores, axis=0, kind="stable")[:limit]
+        scores = np.take_along_axis(scores, order, axis=0)
+        rows = np.take_along_axis(rows, order, axis=0)
+        owners = np.take_along_axis(owners, order, axis=0)
+        return [
+            [(self.segments[owner], int(row), float(score))
+             for owner, row, score in zip(owners[:, i], rows[:, i], scores[:, i])]
+            for i in range(len(queries))
+        ]
+
+
+class SegmentBuilder:
+    """ 写入一个新的段，先写到临时目录，全部写完后再重命名，读取时不会看到写了一半的段 """
+
+    def __init__(self, root: str, dim: int, prefix: str = tmp_prefix):
+        self.dim = dim
+        self.name = _new_name()
+        self.directory = os.path.join(root, segments_dir)
+        self.tmp = os.path.join(self.directory, f"{prefix}{self.name}")
+        os.makedirs(self.tmp)
+        self.ids: list[str] = []
+        self.offsets = [np.zeros(1, dtype=np.uint64)]
+        self.size = 0
+        self.vectors_file = open(os.path.join(self.tmp, "vectors.f32"), "wb")
+        self.docs_file = open(os.path.join(self.tmp, "docs.jsonl"), "wb")
+
+    def append(self, ids: list[str], vectors: np.ndarray, docs: list[bytes]):
+        """ 追加内存里的文本块 """
+        self.ids += ids
+        self.vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        for line in docs:
+            self.docs_file.write(line)
+        lengths = np.fromiter((len(line) for line in docs), dtype=np.uint64, count=len(docs))
+        self.offsets.append(np.uint64(self.size) + np.cumsum(lengths, dtype=np.uint64))
+        self.size += int(lengths.sum())
+
+    def append_segment(self, segment: FlatSegment, stop: threading.Event | None = None):
+        """ 分块复制一个已有的段，stop 被设置时中止 """
+        self.ids += segment.ids
+        for start in range(0, segment.count, flat_search_block):
+            if stop is not None and stop.is_set():
+                raise InterruptedError("合并段被中止")
+            self.vectors_file.write(np.asarray(segment.vectors[start:start + flat_search_block]).tobytes())
+        # 从内存映射复制，段目录在合并期间被清理也不影响
+        size = int(segment.offsets[-1])
+        for start in range(0, size, copy_block):
+            self.docs_file.write(segment.docs[start:min(start + copy_block, size)])
+        self.offsets.append(np.uint64(self.size) + np.asarray(segment.offsets[1:]))
+        self.size += size
+
+    def finish(self) -> str:
+        """ 写入剩余的文件，重命名成正式的段，返回段名称 """
+        for f in (self.vectors_file, self.docs_file):
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+        with open(os.path.join(self.tmp, "offsets.u64"), "wb") as f:
+            f.write(np.concatenate(self.offsets).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(os.path.join(self.tmp, "ids.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(self.ids))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # meta.json 最后写入，读取时以它为准
+        with open(os.path.join(self.tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "count": len(self.ids)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(self.tmp, os.path.join(self.directory, self.name))
+        _fsync_dir(self.directory)
+        return self.name
+
+    def abort(self):
+        """ 删除写了一半的段 """
+        self.vectors_file.close()
+        self.docs_file.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def publish_manifest(root: str, dim: int, segments: list[tuple[str, int]]) -> str:
+    """ 持有写入锁时调用，写入新的快照清单，再原子替换 CURRENT，返回快照名称 """
+    name = _new_name()
+    directory = os.path.join(root, manifests_dir)
+    tmp = os.path.join(directory, f"{tmp_prefix}{name}.json")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"dim": dim, "segments": [{"name": segment, "count": count} for segment, count in segments]}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, os.path.join(directory, f"{name}.json"))
+
+    current_tmp = os.path.join(root, f"{current_name}.tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(current_tmp, os.path.join(root, current_name))
+    _fsync_dir(root)
+    return name
+
+
+class FlatWriter(VectorWriter):
+    """
+    平铺索引的写入会话，新增的文本块先放在内存里，结束时拿到写入锁，写成一个新的段并发布新的快照。
+    会话期间不持有写入锁，多个学习任务可以同时向量化。
+    """
+
+    def __init__(self, base: FlatSnapshot | None):
+        self.base = base
+        self.ids: list[str] = []
+        self.seen: set[str] = set()
+        self.docs: list[bytes] = []
+        self.vectors: list[np.ndarray] = []
+
+    def exists(self, ids: list[str]) -> set[str]:
+        return {id_ for id_ in ids if id_ in self.seen or (self.base and self.base.contains(id_))}
+
+    def add(self, items: list[tuple[str, Document]], vectors: list[list[float]]):
+        matrix = normalize(vectors)
+        dim = self.base.dim if self.base else (self.vectors[0].shape[1] if self.vectors else matrix.shape[1])
+        if matrix.shape[1] != dim:
+            raise ValueError(f"向量维度不一致: {matrix.shape[1]} != {dim}")
+        for id_, doc in items:
+            self.ids.append(id_)
+            self.seen.add(id_)
+            self.docs.append(json.dumps(
+                {"page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False, default=str,
+            ).encode("utf-8") + b"\n")
+        self.vectors.append(matrix)
+
+    def publish(self, root: str, base: FlatSnapshot | None) -> str | None:
+        """
+        持有写入锁时调用，base 是最新的快照。新增的文本块写成一个新的段，快照清单是 base 的段再加上它，
+        不复制已有的段。其他会话同时写入了同样的文本块时跳过它们，全部跳过时不发布，返回 None。
+        """
+        new_vectors = np.concatenate(self.vectors)
+        if base:
+            if new_vectors.shape[1] != base.dim:
+                raise ValueError(f"向量维度不一致: {new_vectors.shape[1]} != {base.dim}")
+            keep = [row for row, id_ in enumerate(self.ids) if not base.contains(id_)]
+            if not keep:
+                return None
+            if len(keep) < len(self.ids):
+                self.ids = [self.ids[row] for row in keep]
+                self.docs = [self.docs[row] for row in keep]
+                new_vectors = new_vectors[keep]
+
+        dim = int(new_vectors.shape[1])
+        builder = SegmentBuilder(root, dim)
+        try:
+            builder.append(self.ids, new_vectors, self.docs)
+            segment = builder.finish()
+        except BaseException:
+            builder.abort()
+            raise
+        segments = [(item.name, item.count) for item in base.segments] if base else []
+        return publish_manifest(root, dim, segments + [(segment, len(self.ids))])
+
+
+class FlatIndexBackend(VectorBackend):
+    """
+    内存映射的 float32 平铺索引，精确检索。
+    读取不加锁，多个进程共享只读快照; 同一时间只有一个进程发布快照，每次只写入新增的段，发布后原子切换。
+    段变多后在后台合并，合并时不持有写入锁，不阻塞写入和检索。
+    """
+
+    name = "flat"
+    multiprocess = True
+    transactional = True
+
+    def __init__(self, root: str = flat_index_path):
+        self.root = root
+        self.location = os.path.abspath(root)
+        os.makedirs(os.path.join(root, manifests_dir), exist_ok=True)
+        os.makedirs(os.path.join(root, segments_dir), exist_ok=True)
+        self._snapshot: FlatSnapshot | None = None
+        # CURRENT 文件的 (inode, 修改时间)，变化后重新打开快照
+        self._current: tuple[int, int] | None = None
+        # 已经打开的段，切换快照时复用，只需要打开新增的段
+        self._segments: dict[str, FlatSegment] = {}
+        self._open_lock = threading.Lock()
+        # 进程内的写入锁，进程之间用文件锁
+        self._write_lock = threading.Lock()
+        # 后台合并段的线程，关闭时中止
+        self._compactor: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def snapshot(self) -> FlatSnapshot | None:
+        """ 获取当前快照，CURRENT 有变化时重新打开，不再使用的段由垃圾回收释放 """
+        path = os.path.join(self.root, current_name)
+        for _ in range(3):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            key = (stat.st_ino, stat.st_mtime_ns)
+            if key == self._current:
+                return self._snapshot
+            with self._open_lock:
+                if key == self._current:
+                    return self._snapshot
+                try:
+                    snapshot = self._open(path)
+                except FileNotFoundError:
+                    # 读取 CURRENT 之后快照或者段被清理了，重新读取
+                    continue
+                log.info("打开向量快照: %s, 段: %s, 文本块: %s", snapshot.name, len(snapshot.segments), snapshot.count)
+                self._snapshot, self._current = snapshot, key
+                self._segments = {segment.name: segment for segment in snapshot.segments}
+                return snapshot
+        raise RuntimeError(f"打开向量快照失败: {self.root}")
+
+    def _open(self, path: str) -> FlatSnapshot:
+        """ 读取 CURRENT 指向的快照清单，只打开还没打开过的段 """
+        with open(path, encoding="utf-8") as f:
+            name = f.read().strip()
+        with open(os.path.join(self.root, manifests_dir, f"{name}.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        segments = [
+            self._segments.get(item["name"]) or FlatSegment(os.path.join(self.root, segments_dir, item["name"]))
+            for item in manifest["segments"]
+        ]
+        return FlatSnapshot(name, manifest["dim"], segments)
+
+    def search(self, vectors: list[list[float]], limit: int) -> list[list[Hit]]:
+        snapshot = self.snapshot()
+        if snapshot is None or not snapshot.count:
+            return [[] for _ in vectors]
+        results = snapshot.search(normalize(vectors), limit)
+        return [
+            [Hit(segment.ids[row], segment.document(row), segment.vectors[row].tolist(), score)
+             for segment, row, score in rows]
+            for rows in results
+        ]
+
+    def scroll(self, batch_size: int = 256) -> Iterator[list[tuple[str, Document]]]:
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return
+        for segment in snapshot.segments:
+            for start in range(0, segment.count, batch_size):
+                rows = range(start, min(start + batch_size, segment.count))
+                yield [(segment.ids[row], segment.document(row)) for row in rows]
+
+    @contextmanager
+    def _file_lock(self, name: str, blocking: bool = True) -> Iterator[bool]:
+        """ 进程之间的文件锁，blocking 为 False 时拿不到锁返回 False """
+        with open(os.path.join(self.root, name), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _writing(self) -> Iterator[FlatSnapshot | None]:
+        """ 持有写入锁，拿到锁之后再读取当前快照，其他进程刚发布的快照也会包含在内 """
+        with self._write_lock, self._file_lock(lock_name):
+            yield self.snapshot()
+
+    @contextmanager
+    def writer(self) -> Iterator[VectorWriter]:
+        writer = FlatWriter(self.snapshot())
+        yield writer
+        if not writer.ids:
+            return
+        with self._writing() as latest:
+            name = writer.publish(self.root, latest)
+            if name is None:
+                return
+            log.info("发布向量快照: %s, 新增文本块: %s", name, len(writer.ids))
+            self._cleanup()
+        self._schedule_compaction()
+
+    def _schedule_compaction(self):
+        """ 段需要合并时启动后台线程，进程内同一时间只有一个 """
+        snapshot = self.snapshot()
+        if snapshot is None or merge_plan([segment.count for segment in snapshot.segments]) is None:
+            return
+        with self._open_lock:
+            if self._stop.is_set() or (self._compactor is not None and self._compactor.is_alive()):
+                return
+            self._compactor = threading.Thread(target=self._compact_in_background, name="flat-compact", daemon=True)
+            self._compactor.start()
+
+    def _compact_in_background(self):
+        """ 后台合并，直到不需要合并或者服务关闭 """
+        try:
+            while not self._stop.is_set() and self.compact():
+                pass
+        except Exception as e:
+            log.error("合并向量段出错: %s", e)
+
+    def compact(self) -> bool:
+        """
+        合并一次段: 先在写入锁外把较新的小段复制成一个新的段，再拿写入锁，把最新快照里的这些段换成合并后的段。
+        合并期间新发布的段排在它们后面，不受影响。其他进程正在合并或者不需要合并时返回 False。
+        """
+        with self._file_lock(compact_lock_name, blocking=False) as locked:
+            if not locked:
+                return False
+            self._remove_partial(merge_prefix)
+            snapshot = self.snapshot()
+            start = merge_plan([segment.count for segment in snapshot.segments]) if snapshot else None
+            if start is None:
+                return False
+
+            merged = [segment.name for segment in snapshot.segments[start:]]
+            builder = SegmentBuilder(self.root, snapshot.dim, merge_prefix)
+            try:
+                for segment in snapshot.segments[start:]:
+                    builder.append_segment(segment, self._stop)
+                with self._writing() as latest:
+                    # 只有合并的进程会删除段，这些段在最新的快照里还是连续的
+                    segments = [(segment.name, segment.count) for segment in latest.segments]
+                    index = [name for name, _ in segments].index(merged[0])
+                    segments[index:index + len(merged)] = [(builder.finish(), len(builder.ids))]
+                    publish_manifest(self.root, latest.dim, segments)
+                    log.info("合并向量段: %s 个段, 文本块: %s", len(merged), len(builder.ids))
+                    self._cleanup()
+            except BaseException:
+                builder.abort()
+                raise
+            return True
+
+    def _remove_partial(self, prefix: str):
+        """ 删除写入失败留下的临时段和临时快照清单 """
+        for directory in (segments_dir, manifests_dir):
+            path = os.path.join(self.root, directory)
+            for name in os.listdir(path):
+                if not name.startswith(prefix):
+                    continue
+                if os.path.isdir(os.path.join(path, name)):
+                    shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+                else:
+                    os.remove(os.path.join(path, name))
+
+    def _cleanup(self):
+        """ 持有写入锁时调用，删除旧的快照清单、保留的快照都没有用到的段和发布失败留下的临时文件 """
+        self._remove_partial(tmp_prefix)
+        directory = os.path.join(self.root, manifests_dir)
+        manifests = sorted(name for name in os.listdir(directory) if not name.startswith("."))
+        keep = manifests[-max(flat_keep_snapshots, 1):]
+        used = set()
+        for name in keep:
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                used.update(item["name"] for item in json.load(f)["segments"])
+        for name in manifests:
+            if name not in keep:
+                os.remove(os.path.join(directory, name))
+        segments = os.path.join(self.root, segments_dir)
+        for name in os.listdir(segments):
+            if not name.startswith(".") and name not in used:
+                shutil.rmtree(os.path.join(segments, name), ignore_errors=True)
+
+    def close(self):
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._open_lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._snapshot, self._current, self._segments = None, None, {}
@@ -0,0 +1,63 @@
+import asyncio
+import os
+from urllib.parse import urlsplit
+
+import httpx
+
+# 连接超时和读取超时, 单位秒
+connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+# 连接池总大小
+max_connections = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+# 每个域名的最大连接数
+max_connections_per_host = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+
+# 进程内共享的异步客户端，复用 keep-alive 连接
+_async_client: httpx.AsyncClient | None = None
+# 每个域名的并发限制
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """ 获取共享的异步 http 客户端 """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+    return _async_client
+
+
+async def close_async_client():
+    """ 关闭共享的异步 http 客户端 """
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    """ 获取域名对应的并发限制 """
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(max_connections_per_host)
+    return semaphore
+
+
+async def arequest(method: str, url: str, **kwargs) -> httpx.Response:
+    """ 使用共享连接池发送异步请求，同一个域名的并发数量有上限 """
+    async with _host_semaphore(url):
+        return await get_async_client().request(method, url, **kwargs)
+
+
+async def aget(url: str, **kwargs) -> httpx.Response:
+    """ 异步 GET 请求 """
+    return await arequest("GET", url, **kwargs)
+
+
+async def apost(url: str, **kwargs) -> httpx.Response:
+    """ 异步 POST 请求 """
+    return await arequest("POST", url, **kwargs)
+
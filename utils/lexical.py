@@ -0,0 +1,203 @@
+import json
+import math
+import os
+import re
+import uuid
+from collections import Counter
+from functools import lru_cache
+
+import jieba
+from langchain_core.documents import Document
+
+from utils.custom_log import log
+from utils.db import redis_client
+
+# BM25 参数
+bm25_k1 = float(os.getenv("BM25_K1", "1.5"))
+bm25_b = float(os.getenv("BM25_B", "0.75"))
+# 自定义词典，比如卦名、生肖配对之类的专有名词，一行一个词
+jieba_user_dict = os.getenv("JIEBA_USER_DICT")
+
+# 倒排索引存在 redis 里，多个进程共享。重建时写入新的版本，完成后再切换，检索不会读到重建了一半的索引。
+# 命名空间是向量数据库的位置，每个向量数据库有自己的倒排索引，切换后端时不会用到其他后端的数据:
+# kb:lex:active:{命名空间} -> 当前使用的索引版本
+# kb:lex:building:{命名空间} -> 正在重建的索引版本，带过期时间，重建期间新写入的文本块同时写入这个版本
+# kb:lex:{版本}:term:{词} -> {文本块 id: 词频}
+# kb:lex:{版本}:len -> {文本块 id: 词数}
+# kb:lex:{版本}:doc -> {文本块 id: 文本块内容和 metadata}
+# kb:lex:{版本}:stats -> {docs: 文本块数量, length: 总词数}
+# 重建的超时时间，单位秒，超时后其他进程可以重新开始重建
+build_timeout = int(os.getenv("LEXICAL_BUILD_TIMEOUT", "600"))
+
+
+def active_key(namespace: str) -> str:
+    """ 当前使用的索引版本 """
+    return f"kb:lex:active:{namespace}"
+
+
+def building_key(namespace: str) -> str:
+    """ 正在重建的索引版本 """
+    return f"kb:lex:building:{namespace}"
+
+
+def term_key(version: str, word: str) -> str:
+    """ 词的倒排列表 """
+    return f"kb:lex:{version}:term:{word}"
+
+
+def length_key(version: str) -> str:
+    """ 文本块的词数 """
+    return f"kb:lex:{version}:len"
+
+
+def doc_key(version: str) -> str:
+    """ 文本块内容 """
+    return f"kb:lex:{version}:doc"
+
+
+def stats_key(version: str) -> str:
+    """ 索引统计 """
+    return f"kb:lex:{version}:stats"
+
+
+# 只保留包含文字或者数字的词，过滤标点和空白
+_word = re.compile(r"\w")
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer() -> jieba.Tokenizer:
+    """ 获取中文分词器，第一次使用时加载词典 """
+    tokenizer = jieba.Tokenizer()
+    if jieba_user_dict:
+        tokenizer.load_userdict(jieba_user_dict)
+    return tokenizer
+
+
+def tokenize(text: str) -> list[str]:
+    """ 中文分词，使用搜索引擎模式，长词会再切出短词，提高召回 """
+    return [word for word in get_tokenizer().lcut_for_search(text.lower()) if _word.search(word)]
+
+
+def get_active(namespace: str) -> str | None:
+    """ 当前使用的索引版本，还没有建好索引时返回 None """
+    version = redis_client.get(active_key(namespace))
+    return version.decode("utf-8") if version else None
+
+
+def add_documents(namespace: str, items: list[tuple[str, Document]], versions: list[str] | None = None):
+    """
+    把文本块写入倒排索引，items 是 (文本块 id, 文本块) 列表，已经写入的文本块会跳过。
+    versions 为 None 时写入当前使用的版本和正在重建的版本，都没有时不写入，之后重建会从向量数据库读到它们。
+    """
+    if not items:
+        return
+    if versions is None:
+        versions = list(dict.fromkeys(
+            version.decode("utf-8") for version in redis_client.mget(active_key(namespace), building_key(namespace)) if version))
+
+    for version in versions:
+        ids = [point_id for point_id, _ in items]
+        existing = redis_client.hmget(length_key(version), ids)
+        new = [item for item, length in zip(items, existing) if length is None]
+        if not new:
+            continue
+
+        pipe = redis_client.pipeline(transaction=False)
+        total = 0
+        for point_id, doc in new:
+            words = Counter(tokenize(doc.page_content))
+            length = sum(words.values())
+            total += length
+            for word, count in words.items():
+                pipe.hset(term_key(version, word), point_id, count)
+            pipe.hset(length_key(version), point_id, length)
+            pipe.hset(doc_key(version), point_id, json.dumps(
+                {"page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False, default=str))
+        pipe.hincrby(stats_key(version), "docs", len(new))
+        pipe.hincrby(stats_key(version), "length", total)
+        pipe.execute()
+        log.info("倒排索引 %s 写入文本块: %s", version, len(new))
+
+
+def clear_index(version: str):
+    """ 删除一个版本的倒排索引 """
+    keys = list(redis_client.scan_iter(term_key(version, "*"), count=1000))
+    keys += [length_key(version), doc_key(version), stats_key(version)]
+    for start in range(0, len(keys), 1000):
+        redis_client.delete(*keys[start:start + 1000])
+
+
+def start_build(namespace: str) -> str | None:
+    """ 开始重建，返回新的索引版本，其他进程正在重建时返回 None """
+    version = uuid.uuid4().hex
+    if not redis_client.set(building_key(namespace), version, nx=True, ex=build_timeout):
+        return None
+    return version
+
+
+def finish_build(namespace: str, version: str):
+    """ 重建完成，切换到新的版本，再删除旧的版本 """
+    old = get_active(namespace)
+    pipe = redis_client.pipeline(transaction=True)
+    # 知识库为空时也记录统计
+    pipe.hsetnx(stats_key(version), "docs", 0)
+    pipe.set(active_key(namespace), version)
+    pipe.delete(building_key(namespace))
+    pipe.execute()
+    if old and old != version:
+        clear_index(old)
+
+
+def abort_build(namespace: str, version: str):
+    """ 重建失败，删除写了一半的版本 """
+    if redis_client.get(building_key(namespace)) == version.encode("utf-8"):
+        redis_client.delete(building_key(namespace))
+    clear_index(version)
+
+
+def search(namespace: str, query: str, k: int = 4) -> list[Document]:
+    """ BM25 检索，不需要向量化，固定四次 redis 往返，还没有建好索引时返回空列表 """
+    words = Counter(tokenize(query))
+    if not words:
+        return []
+    version = get_active(namespace)
+    if version is None:
+        return []
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(stats_key(version))
+    for word in words:
+        pipe.hgetall(term_key(version, word))
+    stats, *postings = pipe.execute()
+    docs = int(stats.get(b"docs", 0))
+    if not docs:
+        return []
+    avg_length = int(stats.get(b"length", 0)) / docs or 1
+
+    # 先算出每个文本块的词频，再一次性取出候选文本块的长度
+    matched: dict[bytes, list[tuple[int, float]]] = {}
+    for (word, query_count), posting in zip(words.items(), postings):
+        if not posting:
+            continue
+        idf = math.log(1 + (docs - len(posting) + 0.5) / (len(posting) + 0.5))
+        for point_id, count in posting.items():
+            matched.setdefault(point_id, []).append((int(count), idf * query_count))
+    if not matched:
+        return []
+
+    ids = list(matched)
+    lengths = redis_client.hmget(length_key(version), ids)
+    scores = {}
+    for point_id, length in zip(ids, lengths):
+        norm = bm25_k1 * (1 - bm25_b + bm25_b * int(length or 0) / avg_length)
+        scores[point_id] = sum(weight * count * (bm25_k1 + 1) / (count + norm) for count, weight in matched[point_id])
+
+    top = sorted(scores, key=scores.get, reverse=True)[:k]
+    documents = []
+    for point_id, data in zip(top, redis_client.hmget(doc_key(version), top)):
+        if data is None:
+            continue
+        doc = Document(**json.loads(data))
+        doc.metadata["_id"] = point_id.decode("utf-8")
+        documents.append(doc)
+    return documents
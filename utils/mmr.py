@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """ 按行归一化，点积就是余弦相似度 """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def mmr_select(
+    query_vectors: np.ndarray,
+    candidate_vectors: np.ndarray,
+    k: int,
+    lambda_mult: float = 0.5,
+    dedupe_threshold: float = 0.98,
+) -> list[int]:
+    """
+    多个问题一起做 MMR，返回选中的候选下标，按选中的顺序排列。
+    候选和问题的相关度取和所有问题相似度的最大值，多个问题的结果一次合并。
+    每一轮只做向量运算: 得分 = lambda * 相关度 - (1 - lambda) * 和已选候选的最大相似度。
+    和已选候选相似度超过 dedupe_threshold 的候选视为重复，不再选中。
+    """
+    count = len(candidate_vectors)
+    if count == 0 or k <= 0:
+        return []
+
+    queries = normalize_rows(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+    candidates = normalize_rows(np.asarray(candidate_vectors, dtype=np.float32))
+
+    # 相关度: (候选数量,)
+    relevance = (candidates @ queries.T).max(axis=1)
+    # 候选之间的相似度: (候选数量, 候选数量)
+    similarity = candidates @ candidates.T
+
+    selected = []
+    # 每个候选和已选候选的最大相似度
+    redundancy = np.full(count, -np.inf, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    for _ in range(min(k, count)):
+        penalty = np.where(np.isfinite(redundancy), redundancy, 0)
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * penalty, -np.inf)
+        best = int(np.argmax(scores))
+        if not np.isfinite(scores[best]):
+            break
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+        available[best] = False
+        available &= redundancy < dedupe_threshold
+    return selected
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import oss2
 from oss2.credentials import EnvironmentVariableCredentialsProvider
 
@@ -14,6 +19,18 @@ bucket = oss2.Bucket(
     bucket_name='yangfei-chat'
 )
 
+# oss2 是同步客户端，放到有界的线程池里执行，避免阻塞事件循环
+oss_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("OSS_WORKERS", "8")),
+    thread_name_prefix="oss"
+)
+
+
+async def run_in_oss_executor(func, *args, **kwargs):
+    """在 oss 线程池中执行同步的 oss 操作"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(oss_executor, partial(func, *args, **kwargs))
+
 
 def upload(name: str, file: bytes):
     """用于上传文件到阿里云OSS"""
@@ -21,6 +38,11 @@ def upload(name: str, file: bytes):
     bucket.put_object(f'audio/{name}', file)
 
 
+def copy(source_name: str, target_name: str):
+    """在云端复制音频文件，不需要重新上传数据"""
+    bucket.copy_object(bucket.bucket_name, f'audio/{source_name}', f'audio/{target_name}')
+
+
 def audio_exists(target_dir: str, filename: str):
     """检查音频是否存在"""
     # 填写Object的完整路径，Object完整路径中不能包含Bucket名称。
@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterator
+
+from langchain_core.documents import Document
+from langchain_text_splitters import TextSplitter
+
+from utils.tokens import count_tokens, get_encoding
+
+# 文档解析是 cpu 密集型的工作，放到进程池里执行，不占用服务进程的 GIL
+parse_workers = int(os.getenv("PARSE_WORKERS", "2"))
+# 进程启动方式，spawn 不会复制服务进程里的线程和连接
+parse_start_method = os.getenv("PARSE_START_METHOD", "spawn")
+# pdf 每个任务解析的页数，大文件按页分批解析，内存占用有上限
+pdf_page_batch = int(os.getenv("PARSE_PDF_PAGE_BATCH", "20"))
+
+# 不同来源的切割参数: (每块的 token 数量, 重叠的 token 数量)，可以用 CHUNK_TOKENS_来源 和 CHUNK_OVERLAP_来源 覆盖
+# map 是 summary 模式下总结用的大块，summary 是总结写入知识库时的切割
+chunk_profiles = {
+    name: (
+        int(os.getenv(f"CHUNK_TOKENS_{name.upper()}", size)),
+        int(os.getenv(f"CHUNK_OVERLAP_{name.upper()}", overlap)),
+    )
+    for name, (size, overlap) in {
+        "default": (500, 50),
+        "pdf": (500, 50),
+        "docx": (500, 50),
+        "txt": (500, 50),
+        "xlsx": (300, 0),
+        "url": (400, 40),
+        "summary": (500, 50),
+        "map": (2000, 100),
+    }.items()
+}
+
+# 句子结束的标点，标点留在句子末尾
+sentence_pattern = re.compile(r'[^。！？；!?;\n]*(?:[。！？；!?;\n]+|$)')
+# 句子太长时再按逗号、顿号和空白切分
+clause_pattern = re.compile(r'[^，、,\s]*(?:[，、,\s]+|$)')
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_parse_executor() -> ProcessPoolExecutor:
+    """ 获取共享的解析进程池，第一次使用时创建 """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=parse_workers,
+                mp_context=multiprocessing.get_context(parse_start_method),
+            )
+        return _executor
+
+
+def shutdown_parse_executor():
+    """ 关闭解析进程池 """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+class TokenTextSplitter(TextSplitter):
+    """
+    按模型 token 数量切割文本，优先在中文句子边界(。！？；)切开，句子太长时再按逗号切，最后按 token 硬切。
+    每个片段的 token 数量只计算一次。
+    """
+
+    def __init__(self, chunk_size: int = 500, chunk_overlap: int = 50, **kwargs):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=count_tokens, **kwargs)
+
+    @staticmethod
+    def _pieces(pattern: re.Pattern, text: str) -> list[str]:
+        """ 按标点切开，标点留在前一段的末尾 """
+        return [piece for piece in pattern.findall(text) if piece]
+
+    def _split_long(self, text: str) -> list[tuple[str, int]]:
+        """ 超长的句子按逗号切开，还是太长的片段按 token 硬切 """
+        pieces = []
+        for clause in self._pieces(clause_pattern, text):
+            tokens = count_tokens(clause)
+            if tokens <= self._chunk_size:
+                pieces.append((clause, tokens))
+                continue
+            encoding = get_encoding()
+            ids = encoding.encode(clause, disallowed_special=())
+            # 按 token 的字符位置切，不会切坏多字节的字符
+            _, offsets = encoding.decode_with_offsets(ids)
+            starts = list(range(0, len(ids), self._chunk_size))
+            cuts = [offsets[i] for i in starts] + [len(clause)]
+            for i, start, end in zip(starts, cuts, cuts[1:]):
+                if end > start:
+                    pieces.append((clause[start:end], min(self._chunk_size, len(ids) - i)))
+        return pieces
+
+    def split_text(self, text: str) -> list[str]:
+        """ 切割文本 """
+        pieces = []
+        for sentence in self._pieces(sentence_pattern, text):
+            tokens = count_tokens(sentence)
+            if tokens > self._chunk_size:
+                pieces.extend(self._split_long(sentence))
+            else:
+                pieces.append((sentence, tokens))
+
+        chunks = []
+        current: list[tuple[str, int]] = []
+        total = 0
+        for piece, tokens in pieces:
+            if current and total + tokens > self._chunk_size:
+                chunks.append("".join(piece for piece, _ in current))
+                # 保留上一块末尾不超过 chunk_overlap 的片段作为重叠
+                overlap, overlap_total = [], 0
+                for item in reversed(current):
+                    if overlap_total + item[1] > self._chunk_overlap or overlap_total + item[1] + tokens > self._chunk_size:
+                        break
+                    overlap.insert(0, item)
+                    overlap_total += item[1]
+                current, total = overlap, overlap_total
+            current.append((piece, tokens))
+            total += tokens
+        if current:
+            chunks.append("".join(piece for piece, _ in current))
+
+        if self._strip_whitespace:
+            chunks = [chunk.strip() for chunk in chunks]
+        return [chunk for chunk in chunks if chunk]
+
+
+@lru_cache(maxsize=None)
+def get_text_splitter(profile: str = "default") -> TokenTextSplitter:
+    """ 获取对应来源的文本切割器 """
+    chunk_size, chunk_overlap = chunk_profiles.get(profile, chunk_profiles["default"])
+    return TokenTextSplitter(
+        chunk_size=chunk_size,  # 每个分割块的 token 数量
+        chunk_overlap=chunk_overlap,  # 分割块之间重叠的 token 数量
+        add_start_index=True,  # 是否在分割块中添加起始索引
+    )
+
+
+def get_extension(doc_path: str) -> str:
+    """ 获取文件扩展名 """
+    return doc_path.split('.')[-1]
+
+
+def pdf_page_count(doc_path: str) -> int:
+    """ pdf 的页数，只读取目录，不解析页面内容 """
+    import pypdf
+
+    return len(pypdf.PdfReader(doc_path).pages)
+
+
+def iter_pages(doc_path: str, start: int = 0, end: int | None = None) -> Iterator[Document]:
+    """ 逐页读取文档，pdf 只读取 [start, end) 范围内的页，其他类型整个文件作为一页或者按加载器的结果返回 """
+    extension = get_extension(doc_path)
+    if extension == 'pdf':
+        import pypdf
+
+        reader = pypdf.PdfReader(doc_path)
+        end = len(reader.pages) if end is None else min(end, len(reader.pages))
+        for page_number in range(start, end):
+            # 和 PyPDFLoader 的 metadata 保持一致
+            yield Document(
+                page_content=reader.pages[page_number].extract_text(),
+                metadata={"source": doc_path, "page": page_number},
+            )
+        return
+
+    from langchain_community.document_loaders import Docx2txtLoader, TextLoader, UnstructuredExcelLoader
+
+    loaders = {
+        'docx': Docx2txtLoader,
+        'xlsx': UnstructuredExcelLoader,
+        'txt': TextLoader,
+    }
+    yield from loaders[extension](doc_path).lazy_load()
+
+
+def parse_range(doc_path: str, profile: str, start: int = 0, end: int | None = None) -> list[Document]:
+    """ 在子进程里执行: 读取一段页面，每读一页就切割一页 """
+    splitter = get_text_splitter(profile)
+    documents = []
+    for page in iter_pages(doc_path, start, end):
+        documents.extend(splitter.split_documents([page]))
+    return documents
+
+
+def parse_documents(doc_path: str, profile: str | None = None) -> Iterator[list[Document]]:
+    """
+    在进程池里解析并切割文档，按页面顺序逐批返回文本块，profile 是切割参数，默认按文件类型选择。
+    pdf 按页分成多个任务并发解析，同时进行的任务数量有上限，已经完成的批次会先返回。
+    """
+    executor = get_parse_executor()
+    profile = profile or get_extension(doc_path)
+    if get_extension(doc_path) != 'pdf':
+        yield executor.submit(parse_range, doc_path, profile).result()
+        return
+
+    total = executor.submit(pdf_page_count, doc_path).result()
+    ranges = deque((start, min(start + pdf_page_batch, total)) for start in range(0, total, pdf_page_batch))
+    pending: deque[Future] = deque()
+    while ranges or pending:
+        # 进行中的任务不超过进程数量的两倍，避免结果堆积在内存里
+        while ranges and len(pending) < parse_workers * 2:
+            start, end = ranges.popleft()
+            pending.append(executor.submit(parse_range, doc_path, profile, start, end))
+        yield pending.popleft().result()
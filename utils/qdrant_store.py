@@ -0,0 +1,185 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Iterator
+
+from langchain_community.vectorstores.qdrant import Qdrant
+from langchain_core.documents import Document
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+
+from chat_consts import qdrant_path
+from utils.custom_log import log
+from utils.vector_backend import Hit, VectorBackend, VectorWriter
+from utils.vector_store import collection_name
+
+# qdrant 服务地址，比如 http://localhost:6333，不配置时使用本地文件
+qdrant_url = os.getenv("QDRANT_URL")
+qdrant_api_key = os.getenv("QDRANT_API_KEY")
+# 连接 qdrant 服务的超时时间，单位秒
+qdrant_timeout = int(os.getenv("QDRANT_TIMEOUT", "10"))
+
+
+def to_document(point) -> Document:
+    """ 读取和 langchain 的 Qdrant 一样格式的 payload """
+    return Document(
+        page_content=point.payload.get(Qdrant.CONTENT_KEY) or "",
+        metadata=point.payload.get(Qdrant.METADATA_KEY) or {},
+    )
+
+
+class QdrantWriter(VectorWriter):
+    """ qdrant 写入会话，写入立即生效 """
+
+    def __init__(self, using: Callable[[], ContextManager[QdrantClient]]):
+        # 每次写入时获取客户端
+        self.using = using
+
+    def exists(self, ids: list[str]) -> set[str]:
+        with self.using() as client:
+            if not client.collection_exists(collection_name):
+                return set()
+            points = client.retrieve(collection_name, ids, with_payload=False, with_vectors=False)
+        return {str(point.id) for point in points}
+
+    def add(self, items: list[tuple[str, Document]], vectors: list[list[float]]):
+        with self.using() as client:
+            if not client.collection_exists(collection_name):
+                # 和 Qdrant.from_texts 创建的集合保持一致
+                client.create_collection(
+                    collection_name,
+                    vectors_config=models.VectorParams(size=len(vectors[0]), distance=models.Distance.COSINE),
+                )
+            client.upsert(collection_name, points=[
+                models.PointStruct(
+                    id=id_,
+                    vector=vector,
+                    # 和 langchain 的 Qdrant 保持一样的格式
+                    payload={Qdrant.CONTENT_KEY: doc.page_content, Qdrant.METADATA_KEY: doc.metadata},
+                )
+                for (id_, doc), vector in zip(items, vectors)
+            ])
+
+
+class QdrantBackend(VectorBackend):
+    """ qdrant 服务，并发读写由服务端保证，多个进程可以同时使用 """
+
+    name = "qdrant"
+    multiprocess = True
+
+    def __init__(self, url: str = qdrant_url, api_key: str | None = qdrant_api_key):
+        log.info("连接 qdrant 服务: %s", url)
+        self.location = url
+        self.client = QdrantClient(url=url, api_key=api_key, timeout=qdrant_timeout)
+
+    @contextmanager
+    def reading(self) -> Iterator[QdrantClient]:
+        """ 读取时使用的客户端 """
+        yield self.client
+
+    def search(self, vectors: list[list[float]], limit: int) -> list[list[Hit]]:
+        with self.reading() as client:
+            if not client.collection_exists(collection_name):
+                return [[] for _ in vectors]
+            results = client.search_batch(collection_name, [
+                models.SearchRequest(vector=vector, limit=limit, with_payload=True, with_vector=True)
+                for vector in vectors
+            ])
+        return [
+            [Hit(str(point.id), to_document(point), point.vector, point.score) for point in points]
+            for points in results
+        ]
+
+    def scroll(self, batch_size: int = 256) -> Iterator[list[tuple[str, Document]]]:
+        with self.reading() as client:
+            if not client.collection_exists(collection_name):
+                return
+            offset = None
+            while True:
+                points, offset = client.scroll(
+                    collection_name, limit=batch_size, offset=offset, with_payload=True, with_vectors=False)
+                yield [(str(point.id), to_document(point)) for point in points]
+                if offset is None:
+                    break
+
+    @contextmanager
+    def writer(self) -> Iterator[VectorWriter]:
+        yield QdrantWriter(self.reading)
+
+    def close(self):
+        self.client.close()
+
+
+class LocalQdrantBackend(QdrantBackend):
+    """
+    本地文件 qdrant, 同一时间只能被一个客户端打开，只能单进程使用。
+    进程内共享一个客户端，用读写锁: 可以同时读取，每次写入时等待正在进行的读取完成，写入会话期间仍然可以检索。
+    """
+
+    name = "qdrant-local"
+    multiprocess = False
+
+    def __init__(self, path: str | None = None):
+        self.path = path or qdrant_path()
+        self.location = self.path
+        self.client: QdrantClient | None = None
+        self._condition = threading.Condition(threading.RLock())
+        self._readers = 0
+        self._writing = False
+
+    def _close(self):
+        """ 关闭共享的客户端 """
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def _get_client(self) -> QdrantClient:
+        """ 获取共享的客户端，第一次使用时打开 """
+        if self.client is None:
+            log.info("打开向量数据库: %s", self.path)
+            self.client = QdrantClient(path=self.path)
+        return self.client
+
+    @contextmanager
+    def reading(self) -> Iterator[QdrantClient]:
+        """ 读取知识库时使用，写入期间会等待 """
+        with self._condition:
+            self._condition.wait_for(lambda: not self._writing)
+            client = self._get_client()
+            self._readers += 1
+        try:
+            yield client
+        finally:
+            with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[QdrantClient]:
+        """ 写入时使用，等待正在进行的读取完成，独占共享的客户端 """
+        with self._condition:
+            self._condition.wait_for(lambda: not self._writing and self._readers == 0)
+            self._writing = True
+            client = self._get_client()
+        try:
+            yield client
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    @contextmanager
+    def writer(self) -> Iterator[VectorWriter]:
+        """ 每次写入时才独占客户端，学习任务的写入会话很长，不会一直挡住检索 """
+        yield QdrantWriter(self._exclusive)
+
+    def close(self):
+        with self._condition:
+            self._close()
+
+
+def get_qdrant_backend() -> QdrantBackend:
+    """ 配置了 QDRANT_URL 时连接 qdrant 服务，否则使用本地文件 """
+    if qdrant_url:
+        return QdrantBackend()
+    return LocalQdrantBackend()
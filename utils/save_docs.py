@@ -1,9 +1,11 @@
+from typing import Callable, Iterator
+
 from langchain_core.documents import Document
-from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader, UnstructuredExcelLoader, TextLoader
 from fastapi import HTTPException, status
 
 from utils.custom_log import log
-from utils.chains import split_texts, split_documents, save_texts, get_map_reduce_chain
+from utils.chains import index_batches, ingest_mode
+from utils.parse import parse_documents
 
 
 class SaveDocs:
@@ -22,65 +24,35 @@ class SaveDocs:
         file_extension = self.get_file_extension(doc_path)
         return file_extension in self.file_extension
 
-    def getFile(self, doc_path: str) -> str | None:
-        """根据文件路径，加载文件内容"""
-        loaders = {
-            'docx': Docx2txtLoader,
-            'pdf': PyPDFLoader,
-            'xlsx': UnstructuredExcelLoader,
-            'txt': TextLoader,
-        }
+    def splitSentences(self, doc_path: str) -> Iterator[list[Document]]:
+        """ 在进程池里解析并分割文档，逐页切割，pdf 按页分批并发解析，解析出一批就返回一批 """
         file_extension = self.get_file_extension(doc_path)
-        loader_class = loaders.get(file_extension)
-        if loader_class:
-            try:
-                loader = loader_class(doc_path)
-                text = loader.load()
-                return text
-            except Exception as e:
-                log.error('加载 %s 文件出错: %s', file_extension, e)
-                return None
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail=f'不支持的文件类型{file_extension}'
-            )
-
-    def splitSentences(self, doc_path: str) -> None | list[Document]:
-        """ 分割文档 """
-        # 获取文档内容
-        full_text = self.getFile(doc_path)
-        if full_text is not None:
-            # 分割文档
-            return split_documents(full_text)
-        else:
-            return None
+        # raw 模式的文本块直接用于检索，按文件类型选择切割参数; summary 模式切成总结用的大块
+        profile = file_extension if ingest_mode == "raw" else "map"
+        count = 0
+        for batch in parse_documents(doc_path, profile):
+            count += len(batch)
+            yield batch
+        log.info('解析 %s 文件完成: %s 个文本块', file_extension, count)
 
     # 向量化与向量存储
-    def save(self, doc_path: str):
+    def save(self, doc_path: str, on_stage: Callable[[str], None] | None = None, metadata: dict | None = None):
+        """ 保存文档，on_stage 在进入每个阶段时调用，用于汇报进度，metadata 是文档的来源信息 """
+        on_stage = on_stage or (lambda name: None)
         if not self.check_file_extension(doc_path):
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="不支持的文件类型"
             )
 
-        documents = self.splitSentences(doc_path)
-        if documents is not None:
-            # 获取 map reduce 链
-            reduce = get_map_reduce_chain()
-            # 合并文档
-            text = reduce.invoke(documents)
-            log.info('合并文档后的文本: %s', text)
-            # 在此分割文档
-            documents_end = split_texts(text["output_text"])
-            # 最终保存文档
-            result = save_texts(documents_end)
-            if not result:
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail="服务器出现异常，请稍后再试"
-                )
-        else:
+        on_stage("load")
+        try:
+            # 按学习模式总结和保存文档，边解析边写入
+            result = index_batches(self.splitSentences(doc_path), metadata, on_stage)
+        except Exception as e:
+            log.error('加载 %s 文件出错: %s', self.get_file_extension(doc_path), e)
+            result = False
+        if not result:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                 detail="服务器出现异常，请稍后再试"
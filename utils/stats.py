@@ -0,0 +1,23 @@
+from utils.db import async_redis_client, redis_client
+
+
+def incr_stat(group: str, field: str, amount: int = 1):
+    """ 累加统计计数，存在 redis 里，多个进程共享 """
+    redis_client.hincrby(f"stats:{group}", field, amount)
+
+
+async def aincr_stat(group: str, field: str, amount: int = 1):
+    """ 异步累加统计计数 """
+    await async_redis_client.hincrby(f"stats:{group}", field, amount)
+
+
+def get_stats(group: str) -> dict[str, int]:
+    """ 获取一组统计计数 """
+    data = redis_client.hgetall(f"stats:{group}")
+    return {key.decode("utf-8"): int(value) for key, value in data.items()}
+
+
+def hit_ratio(stats: dict[str, int], hit: str = "hit", miss: str = "miss") -> float:
+    """ 计算缓存命中率 """
+    total = stats.get(hit, 0) + stats.get(miss, 0)
+    return round(stats.get(hit, 0) / total, 4) if total else 0.0
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import tiktoken
+from langchain_core.messages import BaseMessage
+
+# 每条消息的固定开销，参考 openai 的计算方式
+tokens_per_message = 3
+
+# 消息 token 数量的缓存大小
+message_cache_size = int(os.getenv("TOKEN_CACHE_SIZE", "8192"))
+
+# 按消息哈希缓存的 token 数量
+_message_tokens: OrderedDict[bytes, int] = OrderedDict()
+_message_tokens_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> tiktoken.Encoding:
+    """ 获取本地分词器，模型不认识时使用 cl100k_base """
+    try:
+        return tiktoken.encoding_for_model(os.getenv('OPENAI_MODEL', ''))
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    """ 计算文本的 token 数量 """
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def message_hash(message: BaseMessage) -> bytes:
+    """ 消息的哈希，只和消息类型和内容有关 """
+    return hashlib.blake2b(f"{message.type}\0{message.content}".encode("utf-8"), digest_size=16).digest()
+
+
+def count_message_tokens(message: BaseMessage) -> int:
+    """ 计算单条消息的 token 数量，结果按消息哈希缓存 """
+    key = message_hash(message)
+    with _message_tokens_lock:
+        tokens = _message_tokens.get(key)
+        if tokens is not None:
+            _message_tokens.move_to_end(key)
+            return tokens
+
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    tokens = tokens_per_message + count_tokens(message.type) + count_tokens(content)
+
+    with _message_tokens_lock:
+        _message_tokens[key] = tokens
+        if len(_message_tokens) > message_cache_size:
+            _message_tokens.popitem(last=False)
+    return tokens
@@ -0,0 +1,53 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import ContextManager, Iterator
+
+from langchain_core.documents import Document
+
+
+@dataclass
+class Hit:
+    """ 向量检索结果，带上向量，MMR 重排时使用 """
+    id: str
+    document: Document
+    vector: list[float]
+    score: float
+
+
+class VectorWriter(ABC):
+    """ 一次写入会话，由 VectorBackend.writer 创建 """
+
+    @abstractmethod
+    def exists(self, ids: list[str]) -> set[str]:
+        """ 返回已经存在的文本块 id """
+
+    @abstractmethod
+    def add(self, items: list[tuple[str, Document]], vectors: list[list[float]]):
+        """ 写入文本块和对应的向量 """
+
+
+class VectorBackend(ABC):
+    """ 向量数据库后端 """
+
+    name = ""
+    # 是否可以被多个进程同时使用
+    multiprocess = False
+    # 写入会话是否整体生效: True 表示写入会话正常结束前的写入对检索不可见，失败时全部丢弃
+    transactional = False
+    # 数据所在的位置，比如服务地址或者目录，倒排索引按它区分，切换后端时不会用到其他后端的数据
+    location = ""
+
+    @abstractmethod
+    def search(self, vectors: list[list[float]], limit: int) -> list[list[Hit]]:
+        """ 批量检索，每个向量返回最相似的 limit 个文本块 """
+
+    @abstractmethod
+    def scroll(self, batch_size: int = 256) -> Iterator[list[tuple[str, Document]]]:
+        """ 分批遍历所有文本块 """
+
+    @abstractmethod
+    def writer(self) -> ContextManager[VectorWriter]:
+        """ 写入会话，同一时间只有一个写入者 """
+
+    def close(self):
+        """ 释放资源 """
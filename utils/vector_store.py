@@ -0,0 +1,212 @@
+import hashlib
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from utils.custom_log import log
+from utils.db import redis_client
+from utils import lexical
+from utils.vector_backend import Hit, VectorBackend, VectorWriter
+
+# 知识库集合名称
+collection_name = "local_documents"
+# 每批写入的文本块数量
+upsert_batch_size = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+# 生成文本块 id 的命名空间，相同内容的文本块 id 固定
+point_namespace = uuid.uuid5(uuid.NAMESPACE_URL, collection_name)
+
+# 向量数据库后端:
+# qdrant 配置了 QDRANT_URL 时连接 qdrant 服务，多个进程可以同时读写; 否则使用本地文件，只能单进程使用
+# flat 内存映射的 float32 平铺索引，多个进程共享只读快照，写入时发布新的快照
+vector_backends = ("qdrant", "flat")
+vector_backend = os.getenv("VECTOR_BACKEND", "qdrant")
+
+# 知识库的版本号存在 redis 里，多个进程共享，每次写入后加一，检索缓存随之失效
+generation_key = "kb:generation"
+
+
+# 进程内共享的向量数据库后端
+_backends: dict[str, VectorBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name: str | None = None) -> VectorBackend:
+    """ 获取进程内共享的向量数据库后端，第一次使用时打开 """
+    name = name or vector_backend
+    with _backends_lock:
+        if name not in _backends:
+            if name == "flat":
+                from utils.flat_index import FlatIndexBackend
+                _backends[name] = FlatIndexBackend()
+            elif name == "qdrant":
+                from utils.qdrant_store import get_qdrant_backend
+                _backends[name] = get_qdrant_backend()
+            else:
+                raise ValueError(f"不支持的向量数据库后端: {name}, 可选: {', '.join(vector_backends)}")
+            log.info("向量数据库后端: %s", _backends[name].name)
+        return _backends[name]
+
+
+def close_backends():
+    """ 关闭已经打开的向量数据库后端 """
+    with _backends_lock:
+        for name, backend in _backends.items():
+            try:
+                backend.close()
+            except Exception as e:
+                log.error("关闭向量数据库出错: %s %s", name, e)
+        _backends.clear()
+
+
+def get_generation() -> int:
+    """ 获取知识库的版本号 """
+    return int(redis_client.get(generation_key) or 0)
+
+
+@contextmanager
+def writing() -> Iterator[VectorWriter]:
+    """ 写入知识库时使用，写入完成后版本号加一 """
+    try:
+        with get_backend().writer() as writer:
+            yield writer
+    finally:
+        generation = redis_client.incr(generation_key)
+        log.info("知识库已更新, 版本: %s", generation)
+
+
+def lexical_namespace() -> str:
+    """ 当前向量数据库对应的倒排索引命名空间 """
+    backend = get_backend()
+    return f"{backend.name}:{backend.location}"
+
+
+def search_vectors(vectors: list[list[float]], limit: int) -> list[list[Hit]]:
+    """ 批量向量检索 """
+    return get_backend().search(vectors, limit)
+
+
+def content_hash(text: str) -> str:
+    """ 文本块的内容哈希 """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def point_id(text: str) -> str:
+    """ 根据内容哈希生成固定的文本块 id，重复写入同样的内容只会覆盖同一个点 """
+    return str(uuid.uuid5(point_namespace, content_hash(text)))
+
+
+class VectorSession:
+    """
+    一次学习任务的写入会话，由 ingesting 创建，整个任务只打开一次写入会话，每批只做向量化和写入。
+    写入立即生效的后端每批写入后就写入倒排索引，整体生效的后端在会话结束后再写入。
+    """
+
+    def __init__(self, writer: VectorWriter, namespace: str, batch_size: int = upsert_batch_size):
+        self.writer = writer
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.transactional = get_backend().transactional
+        # 等待会话结束后写入倒排索引的文本块
+        self.pending: list[tuple[str, Document]] = []
+
+    def upsert(self, documents: list[Document], embeddings: Embeddings) -> int:
+        """
+        增量写入文本块，已经存在的文本块不会再次向量化和写入，返回新写入的数量。
+        文档的 metadata 是来源信息，会和内容哈希一起保存到每个文本块里。
+        """
+        # 重复的文本块只保留第一个
+        unique: dict[str, Document] = {}
+        for doc in documents:
+            if doc.page_content.strip():
+                unique.setdefault(point_id(doc.page_content), doc)
+        items = list(unique.items())
+
+        added = 0
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            existing = self.writer.exists([id_ for id_, _ in batch])
+            new = [(id_, doc) for id_, doc in batch if id_ not in existing]
+            if not new:
+                continue
+
+            vectors = embeddings.embed_documents([doc.page_content for _, doc in new])
+            new = [
+                (id_, Document(
+                    page_content=doc.page_content,
+                    metadata={**doc.metadata, "content_hash": content_hash(doc.page_content)},
+                ))
+                for id_, doc in new
+            ]
+            self.writer.add(new, vectors)
+            added += len(new)
+            if self.transactional:
+                self.pending += new
+            else:
+                # 写入已经生效，关键词检索不会查到向量数据库里没有的文本块
+                lexical.add_documents(self.namespace, new)
+
+        log.info("写入文本块: 新增 %s, 跳过 %s", added, len(items) - added)
+        return added
+
+
+@contextmanager
+def ingesting(batch_size: int = upsert_batch_size) -> Iterator[VectorSession]:
+    """
+    打开一次学习任务的写入会话，会话结束后写入生效，再写入倒排索引，版本号加一。
+    学习任务在学习线程池里执行，还没有倒排索引时先在这里建好，知识库为空时直接启用空的索引。
+    """
+    ensure_lexical_index(batch_size)
+    namespace = lexical_namespace()
+    with writing() as writer:
+        session = VectorSession(writer, namespace, batch_size)
+        yield session
+    # 写入生效后再写入倒排索引
+    _add_lexical(namespace, session.pending, batch_size)
+
+
+def upsert_documents(documents: list[Document], embeddings: Embeddings, batch_size: int = upsert_batch_size) -> int:
+    """ 单独打开一次写入会话，增量写入文本块，返回新写入的数量 """
+    with ingesting(batch_size) as session:
+        return session.upsert(documents, embeddings)
+
+
+def _add_lexical(namespace: str, items: list[tuple[str, Document]], batch_size: int):
+    """ 分批写入倒排索引 """
+    for start in range(0, len(items), batch_size):
+        lexical.add_documents(namespace, items[start:start + batch_size])
+
+
+def upsert_texts(texts: list[str], embeddings: Embeddings, metadata: dict | None = None) -> int:
+    """ 增量写入文本，metadata 是所有文本共同的来源信息 """
+    return upsert_documents([Document(page_content=text, metadata=dict(metadata or {})) for text in texts], embeddings)
+
+
+def ensure_lexical_index(batch_size: int = 256):
+    """
+    当前向量数据库还没有倒排索引时(比如新部署、升级前写入的数据、切换了后端)，从向量数据库重建一次。
+    在服务启动时和学习任务里调用，都在学习线程池里执行，不在检索时调用。
+    重建写入新的版本，完成后再切换，期间关键词检索返回空结果；切换后版本号加一，重建期间缓存的检索结果失效。
+    """
+    namespace = lexical_namespace()
+    if redis_client.exists(lexical.active_key(namespace)):
+        return
+    # 多个进程同时发现时只重建一次
+    version = lexical.start_build(namespace)
+    if version is None:
+        return
+    try:
+        count = 0
+        for items in get_backend().scroll(batch_size):
+            lexical.add_documents(namespace, items, [version])
+            count += len(items)
+        lexical.finish_build(namespace, version)
+    except Exception:
+        lexical.abort_build(namespace, version)
+        raise
+    generation = redis_client.incr(generation_key)
+    log.info("倒排索引 %s 重建完成: %s, 知识库版本: %s", namespace, count, generation)